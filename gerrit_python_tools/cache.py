@@ -0,0 +1,141 @@
+"""
+Persistent bare mirrors of downstream repositories. Scratch repositories
+borrow objects from a mirror through git alternates so fetches from
+downstream only transfer objects the mirror does not already have.
+
+Pooled scratch repositories keep pointing at a mirror between uses, so a
+mirror must never lose objects. Mirrors are fetched without pruning and
+never garbage collected.
+
+"""
+import git
+import log
+import os
+import threading
+import time
+
+logger = log.get_logger()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class RepoCache(object):
+    """
+    Keeps one bare mirror per project under root. A mirror is refreshed
+    with an incremental fetch of heads and tags at most once every refresh
+    seconds. Refs deleted on downstream are kept.
+
+    """
+    def __init__(self, root, refresh=60):
+        """
+        Inits the cache.
+
+        @param root - String directory holding the mirrors
+        @param refresh - Float minimum seconds between refreshes of a mirror
+
+        """
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.refresh = float(refresh)
+        self._refreshed = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def path(self, project):
+        """
+        Returns the directory of the mirror of a project.
+
+        @param project - String project name
+        @returns String
+
+        """
+        return os.path.join(self.root, '%s.git' % project)
+
+    def _project_lock(self, project):
+        """
+        Returns the lock guarding the mirror of a project.
+
+        @param project - String project name
+        @returns threading.Lock
+
+        """
+        with self._lock:
+            return self._locks.setdefault(project, threading.Lock())
+
+    def ensure(self, project, url):
+        """
+        Creates the mirror of a project if needed and refreshes it if it
+        was not refreshed recently. A failed refresh is logged, the mirror
+        is still usable.
+
+        @param project - String project name
+        @param url - String url of the project on downstream
+        @returns String directory of the mirror
+
+        """
+        path = self.path(project)
+        with self._project_lock(project):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+                git.init(bare=True, cwd=path)
+
+            # Also covers mirrors created before gc was turned off
+            if project not in self._refreshed:
+                git.set_config('gc.auto', '0', cwd=path)
+
+            if time.time() - self._refreshed.get(project, 0) >= self.refresh:
+                try:
+                    git.fetch(url, ['+refs/heads/*:refs/heads/*',
+                                    '+refs/tags/*:refs/tags/*'], cwd=path)
+                    self._refreshed[project] = time.time()
+                except Exception:
+                    logger.exception("Project %s: Unable to refresh mirror"
+                                     % project)
+        return path
+
+    def borrow(self, project, url, repo_dir):
+        """
+        Makes the repo at repo_dir use the objects of the project's mirror
+        through git alternates. Does nothing if it already does.
+
+        @param project - String project name
+        @param url - String url of the project on downstream
+        @param repo_dir - String directory of a non bare repo
+
+        """
+        objects = os.path.join(self.ensure(project, url), 'objects')
+        alternates = os.path.join(repo_dir, '.git', 'objects', 'info',
+                                  'alternates')
+        try:
+            with open(alternates, 'r') as f:
+                if objects in f.read().splitlines():
+                    return
+        except IOError:
+            pass
+        with open(alternates, 'a') as f:
+            f.write('%s\n' % objects)
+        logger.debug("Project %s: Borrowing objects from %s"
+                     % (project, objects))
+
+
+def get_cache(conf):
+    """
+    Returns the process wide RepoCache set up from the cache section of
+    conf or None if the cache is disabled.
+
+    @param conf - config.Config
+    @returns RepoCache|None
+
+    """
+    section = conf['cache']
+    if not section['enabled']:
+        return None
+
+    root = section['root']
+    with _caches_lock:
+        cache = _caches.get(root)
+        if cache is None:
+            cache = RepoCache(root)
+            _caches[root] = cache
+        cache.refresh = float(section['refresh'])
+    return cache
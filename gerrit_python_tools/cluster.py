@@ -0,0 +1,137 @@
+"""
+Shares the work of several gerrit-python-tools daemons using one state
+file. Each daemon is a member that renews a lease on its membership with
+heartbeats. Members whose lease expired are considered dead. Projects are
+assigned to the live members by rendezvous hashing, so when a member joins
+or dies only the projects it owned move. Work done once for the whole
+deployment, like trigger sweeps, is owned by the leader.
+
+"""
+import hashlib
+import log
+import os
+import socket
+import threading
+import time
+
+logger = log.get_logger()
+
+# Key of the work done by one member for the whole deployment
+LEADER = '@leader'
+
+
+class Cluster(object):
+    """
+    Membership of a daemon in a group of daemons sharing a state.Store.
+    Ownership is decided from the members seen at the last heartbeat, so
+    deciding it does not touch the store.
+
+    """
+    def __init__(self, store, member_id=None, ttl=30):
+        """
+        Inits the membership. The daemon is not announced until the first
+        heartbeat.
+
+        @param store - state.Store shared by the members
+        @param member_id - String unique id of this member or None for
+            <hostname>:<pid>
+        @param ttl - Number of seconds a heartbeat keeps a member alive
+
+        """
+        self.store = store
+        self.id = member_id or '%s:%s' % (socket.gethostname(), os.getpid())
+        self.ttl = float(ttl)
+        self._members = (self.id,)
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    @property
+    def members(self):
+        """
+        Returns the ids of the live members as of the last heartbeat.
+
+        @returns Tuple of strings
+
+        """
+        return self._members
+
+    def heartbeat(self, now=None):
+        """
+        Renews the membership lease of this member and reloads the live
+        members. Rows of members dead for ten leases are removed.
+
+        @param now - Float current time or None
+        @returns Tuple of strings - The live members
+
+        """
+        now = now or time.time()
+        self.store.set('members', self.id, {'seen': now})
+
+        live = set([self.id])
+        for member, entry in self.store.items('members'):
+            seen = entry.get('seen', 0)
+            if seen >= now - self.ttl:
+                live.add(member)
+            elif seen < now - 10 * self.ttl:
+                self.store.delete('members', member)
+        live = tuple(sorted(live))
+
+        with self._lock:
+            if live != self._members:
+                logger.info("Cluster members: %s" % ", ".join(live))
+                self._members = live
+                self._owners = {}
+        return live
+
+    def owner(self, key):
+        """
+        Returns the member owning key, the member with the highest hash of
+        its id and key.
+
+        @param key - String key such as a project name
+        @returns String
+
+        """
+        with self._lock:
+            owner = self._owners.get(key)
+            if owner is None:
+                owner = max(self._members, key=lambda m: hashlib.sha1(
+                    (u'%s\0%s' % (m, key)).encode('utf-8')
+                ).digest())
+                self._owners[key] = owner
+            return owner
+
+    def owns(self, key):
+        """
+        Returns whether or not this member owns key.
+
+        @param key - String key such as a project name
+        @returns Boolean
+
+        """
+        return self.owner(key) == self.id
+
+    def leave(self):
+        """
+        Gives up the membership so the work of this member moves to the
+        other members right away.
+
+        """
+        self.store.delete('members', self.id)
+        logger.info("Left the cluster as %s." % self.id)
+
+
+def from_config(conf, store):
+    """
+    Returns the Cluster set up from the cluster section of conf or None
+    if the daemon runs alone.
+
+    @param conf - config.Config
+    @param store - state.Store
+    @returns Cluster|None
+
+    """
+    section = conf['cluster']
+    if not section['enabled']:
+        return None
+    return Cluster(store, member_id=section['id'], ttl=section['ttl'])
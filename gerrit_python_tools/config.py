@@ -1,5 +1,31 @@
+import collections
+import hashlib
+import logging
+import os
+import re
+import threading
 import yaml
 
+# Use the libyaml based loader when it is available.
+YamlLoader = getattr(yaml, 'CLoader', yaml.Loader)
+
+# The log module reads its settings through this module, so the logger is
+# looked up by name rather than with log.get_logger.
+logger = logging.getLogger('gerrit-python-tools')
+
+# Roles a remote plays for a project
+DOWNSTREAM = 'downstream'
+UPSTREAM = 'upstream'
+
+# Remotes configured by the gerrit and upstream sections
+DEFAULT_DOWNSTREAM = 'gerrit'
+DEFAULT_UPSTREAM = 'upstream'
+
+LabelPolicy = collections.namedtuple('LabelPolicy', ['name', 'min', 'max'])
+
+ConfigDiff = collections.namedtuple('ConfigDiff',
+                                    ['full', 'groups', 'users', 'projects'])
+
 
 def get_default_projects_config():
     """
@@ -37,7 +63,58 @@ def get_default_projects_config():
             'sleep': 5,
             'delay': 60 * 2,
             'upstream': True,
-            'sync': True
+            'sync': True,
+            'acl': True,
+            'batch-window': 5
+        },
+        'sync': {
+            'verify-rate': 0.05,
+            'jobs': 1
+        },
+        'scheduler': {
+            'numthreads': 2,
+            'heavy': 300,
+            'heavy-limit': 1,
+            'min-interval': 60
+        },
+        'mirror': {
+            'interval': 300,
+            'numthreads': 4,
+            'report': 300
+        },
+        'cache': {
+            'enabled': True,
+            'root': '~/cache/gerrit-python-tools/mirrors',
+            'refresh': 60
+        },
+        'sweep': {
+            'enabled': True,
+            'interval': 900,
+            'overlap': 300,
+            'retries': 3
+        },
+        'reconcile': {
+            'enabled': True,
+            'interval': 600,
+            'batch': 100
+        },
+        'ssh': {
+            'multiplex': True,
+            'persist': 60
+        },
+        'workspace': {
+            'root': '~/tmp/gerrit-python-tools',
+            'size': 1,
+            'quota': 0
+        },
+        'state': {
+            'file': '~/lib/gerrit-python-tools/state.db'
+        },
+        'cluster': {
+            'enabled': False,
+            'id': None,
+            'heartbeat': 10,
+            'ttl': 30
         },
         'upstream-labels': [
             {
@@ -83,7 +160,7 @@ def merge_dict(a, b):
     return a
 
 
-def load_config(filename, default=None):
+def read_config(filename, default=None):
     """
     Reads a yaml file located at filename.
     Updates the default configuration with information from
@@ -93,6 +170,21 @@ def load_config(filename, default=None):
     @param default - Dictionary, default configuration
     @return dict
 
+    """
+    # Read in yaml config file
+    with open(filename, 'r') as f:
+        contents = f.read()
+    return parse_config(contents, default=default)
+
+
+def parse_config(contents, default=None):
+    """
+    Parses yaml contents and updates the default configuration with them.
+
+    @param contents - String yaml
+    @param default - Dictionary, default configuration
+    @return dict
+
     """
     if default is None:
         default = get_default_projects_config()
@@ -100,10 +192,438 @@ def load_config(filename, default=None):
     # Copy the default config
     config = default
 
-    # Read in yaml config file
-    with open(filename, 'r') as f:
-        diff = yaml.load(f)
+    diff = yaml.load(contents, Loader=YamlLoader)
 
     # Update config
     config = merge_dict(config, diff)
     return config
+
+
+def freeze(value):
+    """
+    Recursively converts dictionaries into FrozenDicts and lists into
+    tuples.
+
+    @param value - Value to freeze
+    @return Frozen value
+
+    """
+    if isinstance(value, dict):
+        return FrozenDict(value)
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class FrozenDict(collections.Mapping):
+    """
+    Read only dictionary. Nested dictionaries and lists are frozen as well.
+
+    """
+    def __init__(self, data):
+        """
+        Inits the FrozenDict.
+
+        @param data - Dictionary
+
+        """
+        self._data = dict((k, freeze(v)) for k, v in data.iteritems())
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+
+class Config(FrozenDict):
+    """
+    Compiled, immutable projects configuration. Behaves like the merged
+    configuration dictionary and additionally provides precomputed lookups
+    so per event work does not grow with the number of configured projects.
+
+    """
+    def __init__(self, data):
+        """
+        Freezes the configuration and compiles the project index, label
+        policies, trigger regexes and remotes.
+
+        @param data - Dictionary, merged configuration
+
+        """
+        # Imported here, gerrit imports log which imports this module.
+        import gerrit
+
+        super(Config, self).__init__(data)
+
+        # Project name index, kept in configuration order
+        self.projects = collections.OrderedDict()
+        for p in self.get('projects', ()):
+            project = gerrit.Project(p)
+            self.projects[project.name] = project
+
+        self.upstream_projects = frozenset(
+            p.name for p in self.projects.itervalues() if p.upstream
+        )
+
+        # Label policies. Projects without their own labels share the
+        # default policy.
+        self.default_labels = compile_labels(self.get('upstream-labels', ()))
+        self.labels = dict(
+            (p.name, compile_labels(p.upstream_labels))
+            for p in self.projects.itervalues()
+            if p.upstream_labels is not None
+        )
+
+        # Trigger regexes. Projects may override the upstream trigger.
+        self.default_trigger = compile_trigger(self['upstream']['trigger'])
+        self.triggers = dict(
+            (p.name, compile_trigger(p.trigger))
+            for p in self.projects.itervalues()
+            if p.trigger is not None
+        )
+
+        # Stat of each project's ACL file. Used to notice edits to the file
+        # when diffing configurations.
+        self.acl_stamps = dict(
+            (p.name, file_stamp(p.config))
+            for p in self.projects.itervalues() if p.config
+        )
+
+        # Remotes shared by all callers. The gerrit and upstream sections
+        # configure the default downstream and upstream. Named remotes
+        # take their missing settings from the gerrit section defaults.
+        self.remotes = {
+            DEFAULT_DOWNSTREAM: gerrit.Remote(self['gerrit'],
+                                              name=DEFAULT_DOWNSTREAM),
+            DEFAULT_UPSTREAM: gerrit.Remote(self['upstream'],
+                                            name=DEFAULT_UPSTREAM)
+        }
+        for name, settings in self.get('remotes', {}).iteritems():
+            if name in self.remotes:
+                raise ValueError("Remote name %s is reserved" % name)
+            data = get_default_projects_config()['gerrit']
+            data.update(settings)
+            self.remotes[name] = gerrit.Remote(data, name=name)
+
+        # Downstream and upstream remote names of each project
+        self.topology = {}
+        for project in self.projects.itervalues():
+            pair = (project.downstream or DEFAULT_DOWNSTREAM,
+                    project.upstream_remote or DEFAULT_UPSTREAM)
+            for name in pair:
+                if name not in self.remotes:
+                    raise ValueError("Project %s: Unknown remote %s"
+                                     % (project.name, name))
+            self.topology[project.name] = pair
+
+        # Roles of the remotes in use. The default pair is always in use.
+        self.remote_roles = {
+            DEFAULT_DOWNSTREAM: set([DOWNSTREAM]),
+            DEFAULT_UPSTREAM: set([UPSTREAM])
+        }
+        for downstream, upstream in self.topology.itervalues():
+            self.remote_roles.setdefault(downstream, set()).add(DOWNSTREAM)
+            self.remote_roles.setdefault(upstream, set()).add(UPSTREAM)
+        self.downstream_names = sorted(
+            n for n, roles in self.remote_roles.iteritems()
+            if DOWNSTREAM in roles
+        )
+
+    def project(self, name):
+        """
+        Returns the gerrit.Project named name or None.
+
+        @param name - String project name
+        @return gerrit.Project|None
+
+        """
+        return self.projects.get(name)
+
+    def remote_names(self, project_name):
+        """
+        Returns the names of the downstream and upstream remotes of a
+        project. Projects that are not configured use the default pair.
+
+        @param project_name - String project name
+        @return Tuple (String, String)
+
+        """
+        return self.topology.get(project_name,
+                                 (DEFAULT_DOWNSTREAM, DEFAULT_UPSTREAM))
+
+    def downstream(self, project_name):
+        """
+        Returns the downstream remote of a project.
+
+        @param project_name - String project name
+        @return gerrit.Remote
+
+        """
+        return self.remotes[self.remote_names(project_name)[0]]
+
+    def upstream(self, project_name):
+        """
+        Returns the upstream remote of a project.
+
+        @param project_name - String project name
+        @return gerrit.Remote
+
+        """
+        return self.remotes[self.remote_names(project_name)[1]]
+
+    def roles(self, remote_name, project_name):
+        """
+        Returns the roles a remote plays for a project.
+
+        @param remote_name - String remote name
+        @param project_name - String project name
+        @return Tuple of DOWNSTREAM and/or UPSTREAM
+
+        """
+        downstream, upstream = self.remote_names(project_name)
+        roles = ()
+        if remote_name == downstream:
+            roles += (DOWNSTREAM,)
+        if remote_name == upstream:
+            roles += (UPSTREAM,)
+        return roles
+
+    def label_policies(self, project_name):
+        """
+        Returns the label policies gating sends upstream for a project.
+
+        @param project_name - String project name
+        @return Tuple of LabelPolicy
+
+        """
+        return self.labels.get(project_name, self.default_labels)
+
+    def trigger(self, project_name):
+        """
+        Returns the compiled trigger regex for a project.
+
+        @param project_name - String project name
+        @return Compiled regex
+
+        """
+        return self.triggers.get(project_name, self.default_trigger)
+
+    def trigger_text(self, project_name):
+        """
+        Returns the trigger string for a project.
+
+        @param project_name - String project name
+        @return String
+
+        """
+        project = self.projects.get(project_name)
+        if project is not None and project.trigger is not None:
+            return project.trigger
+        return self['upstream']['trigger']
+
+
+def file_stamp(filename):
+    """
+    Returns the (mtime, size) of a file or None if it cannot be stat'ed.
+
+    @param filename - String filename
+    @return Tuple|None
+
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def changed_entries(old, new, key):
+    """
+    Returns the keys of entries in new that are not in old or differ
+    from their counterpart in old. Removed entries are ignored.
+
+    @param old - Iterable of dictionaries
+    @param new - Iterable of dictionaries
+    @param key - String key identifying an entry
+    @return List of keys
+
+    """
+    old = dict((e.get(key), e) for e in old)
+    return [e.get(key) for e in new if old.get(e.get(key)) != e]
+
+
+def diff(old, new):
+    """
+    Compares two compiled configurations and returns the entities that need
+    to be synced. A change to the gerrit or remotes section requires a full
+    sync.
+
+    @param old - Config
+    @param new - Config
+    @return ConfigDiff
+
+    """
+    if (old['gerrit'] != new['gerrit'] or
+            old.get('remotes') != new.get('remotes')):
+        return ConfigDiff(True, [], [], [])
+
+    groups = changed_entries(old.get('groups', ()), new.get('groups', ()),
+                             'name')
+    users = changed_entries(old.get('users', ()), new.get('users', ()),
+                            'username')
+    projects = changed_entries(old.get('projects', ()),
+                               new.get('projects', ()), 'name')
+
+    # ACL files may be edited in place without touching the yaml file.
+    for name, stamp in new.acl_stamps.iteritems():
+        if name not in projects and old.acl_stamps.get(name) != stamp:
+            projects.append(name)
+
+    return ConfigDiff(False, groups, users, projects)
+
+
+def compile_labels(label_dicts):
+    """
+    Converts label dictionaries into a tuple of LabelPolicy.
+
+    @param label_dicts - List of dictionaries with name, min and max keys
+    @return Tuple of LabelPolicy
+
+    """
+    return tuple(LabelPolicy(l['name'], int(l['min']), int(l['max']))
+                 for l in label_dicts)
+
+
+def compile_trigger(trigger):
+    """
+    Compiles a trigger string(Verified+2, etc) into a regex.
+
+    @param trigger - String trigger
+    @return Compiled regex
+
+    """
+    return re.compile(re.escape(trigger))
+
+
+def load_config(filename, default=None):
+    """
+    Reads the projects configuration located at filename and compiles it.
+
+    @param filename - String filename
+    @param default - Dictionary, default configuration
+    @return Config
+
+    """
+    return Config(read_config(filename, default=default))
+
+
+class ConfigCache(object):
+    """
+    Caches the compiled configuration of a single file. The file is only
+    parsed again when its mtime or size changed and its content hash
+    differs, or when a reload was requested. Snapshots are immutable and
+    replaced atomically so callers keep the snapshot they started with.
+
+    """
+    def __init__(self, filename):
+        """
+        Inits the cache. Nothing is read until get is called.
+
+        @param filename - String filename
+
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._digest = None
+        self._config = None
+        self._stale = False
+
+    def invalidate(self):
+        """
+        Forces the next get to reread the file. Safe to call from a
+        signal handler.
+
+        """
+        self._stale = True
+
+    def get(self):
+        """
+        Returns the current configuration snapshot, reloading it first if
+        the file changed.
+
+        A file that can not be read, parsed or validated keeps the last
+        good snapshot in use. Errors are only raised when there is none.
+
+        @return Config
+
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            if self._config is None:
+                raise
+            logger.exception("Unable to stat %s, keeping the last good "
+                             "configuration." % self.filename)
+            return self._config
+        stamp = (st.st_mtime, st.st_size)
+        config = self._config
+        if config is not None and stamp == self._stamp and not self._stale:
+            return config
+
+        with self._lock:
+            # A requested reload recompiles even unchanged contents so
+            # edits to files referenced by the configuration are seen.
+            stale = self._stale
+            self._stale = False
+            try:
+                with open(self.filename, 'r') as f:
+                    contents = f.read()
+                digest = hashlib.sha1(contents).hexdigest()
+                if self._config is None or stale or digest != self._digest:
+                    self._config = Config(parse_config(contents))
+                    self._digest = digest
+            except Exception:
+                if self._config is None:
+                    raise
+                logger.exception("Unable to reload %s, keeping the last "
+                                 "good configuration." % self.filename)
+            # A bad file is not parsed again until it changes
+            self._stamp = stamp
+            return self._config
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_config(filename):
+    """
+    Returns the cached, compiled configuration for filename.
+
+    @param filename - String filename
+    @return Config
+
+    """
+    cache = _caches.get(filename)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.setdefault(filename, ConfigCache(filename))
+    return cache.get()
+
+
+def reload_configs(signum=None, frame=None):
+    """
+    Marks every cached configuration for reload. Usable as a SIGHUP
+    handler.
+
+    """
+    for cache in _caches.values():
+        cache.invalidate()
@@ -1,3 +1,6 @@
+import atexit
+import cache
+import collections
 import git
 import hashlib
 import json
@@ -9,15 +12,21 @@ import pipes
 import pprint
 import Queue
 import re
-import shutil
+import state
 import StringIO
 import subprocess
+import threading
 import time
 import utils
-from thread import StoppableThread
-from uuid import uuid4
+import workspace
+from thread import StoppableThread, WorkerPool
 from pipes import quote
 
+# Shared connection pools and review queues keyed by connection info
+_ssh_pools = {}
+_review_queues = {}
+_registry_lock = threading.Lock()
+
 # Turn down the logging output of paramiko
 log.get_logger('paramiko').setLevel(logging.ERROR)
 
@@ -26,6 +35,9 @@ logger = log.get_logger()
 
 PRESERVE_ALL_BRANCHES = "ALL"
 
+# Revision of a ref that does not exist in ref-updated events
+NULL_REVISION = '0' * 40
+
 GERRIT_SYSTEM_GROUPS = [
     {
         'uuid': 'global:Anonymous-Users',
@@ -54,13 +66,20 @@ class SSHStream(StoppableThread):
     to the queue.
 
     """
-    def __init__(self, host, port, timeout, username, key_filename, keepalive):
+    def __init__(self, host, port, timeout, username, key_filename, keepalive,
+                 types=None):
         """
         Class constructor. Cleans numbers and starts a queue.
 
+        @param types - List of event types to subscribe to. None for all
+            events.
+
         """
         super(SSHStream, self).__init__()
         self._queue = Queue.Queue()
+        self._command = 'gerrit stream-events'
+        for type_ in types or ():
+            self._command += ' -s %s' % quote(type_)
 
         self._ssh_kwargs = {
             'username': username,
@@ -113,7 +132,7 @@ class SSHStream(StoppableThread):
             try:
                 client.connect(self._host, **(self._ssh_kwargs))
                 client.get_transport().set_keepalive(self._keepalive)
-                _, stdout, _ = client.exec_command('gerrit stream-events')
+                _, stdout, _ = client.exec_command(self._command)
 
                 # Inner loop - Manage reading from stream
                 while not stdout.channel.exit_status_ready():
@@ -166,24 +185,40 @@ class SSH(object):
 
         self._host = host
 
-    def exec_once(self, cmd):
+    def _connect(self):
         """
-        Executes a command once
+        Opens a connection to gerrit.
 
-        @param cmd - String command to execute.
-        @return Two tuple comprised of the return code and stdout if
-            the return code is 0. Returns the stderr if the retcode
-            is non zero
+        @returns paramiko.SSHClient
 
         """
-        logger.debug("Executing: %s" % cmd)
         client = paramiko.SSHClient()
         client.load_system_host_keys()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
         client.connect(self._host, **(self._ssh_kwargs))
+        return client
+
+    def _exec(self, client, cmd):
+        """
+        Executes a command on an open connection.
+
+        @param client - paramiko.SSHClient
+        @param cmd - String command to execute.
+        @return Two tuple comprised of the return code and stdout
+
+        """
+        return self._run(client.get_transport().open_session(), cmd)
+
+    def _run(self, chan, cmd):
+        """
+        Executes a command on a newly opened session.
+
+        @param chan - paramiko.Channel
+        @param cmd - String command to execute.
+        @return Two tuple comprised of the return code and stdout
 
-        chan = client.get_transport().open_session()
+        """
+        logger.debug("Executing: %s" % cmd)
         chan.exec_command(cmd)
 
         contents = StringIO.StringIO()
@@ -206,11 +241,305 @@ class SSH(object):
 
         retcode = chan.recv_exit_status()
         output = contents.getvalue()
-        client.close()
 
         logger.debug(output)
         return retcode, output
 
+    def exec_lines(self, cmd):
+        """
+        Executes a command and yields its stdout one line at a time as it
+        arrives. The connection is closed when the generator is exhausted
+        or closed.
+
+        @param cmd - String command to execute.
+        @yields - String line
+        @raises Exception if the command returns a non zero return code
+
+        """
+        logger.debug("Executing: %s" % cmd)
+        client = self._connect()
+        try:
+            chan = client.get_transport().open_session()
+            chan.exec_command(cmd)
+            for line in chan.makefile('r'):
+                yield line
+            retcode = chan.recv_exit_status()
+            if retcode:
+                raise Exception("Command returned %s: %s" % (retcode, cmd))
+        finally:
+            client.close()
+
+    def exec_once(self, cmd):
+        """
+        Executes a command once
+
+        @param cmd - String command to execute.
+        @return Two tuple comprised of the return code and stdout if
+            the return code is 0. Returns the stderr if the retcode
+            is non zero
+
+        """
+        client = self._connect()
+        try:
+            return self._exec(client, cmd)
+        finally:
+            client.close()
+
+
+class SSHPool(object):
+    """
+    Keeps connections of an SSH object open for reuse. A command that could
+    not be sent because no session could be opened is retried on a new
+    connection, waiting backoff seconds before the first retry and twice as
+    long before each following one. Commands are never retried once sent,
+    since they may have run.
+
+    """
+    def __init__(self, ssh, size=2, retries=3, backoff=1.0):
+        """
+        Inits the pool.
+
+        @param ssh - gerrit.SSH used to open connections
+        @param size - Integer number of idle connections to keep
+        @param retries - Integer number of retries of a command
+        @param backoff - Float seconds to wait before the first retry
+
+        """
+        self.ssh = ssh
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        """
+        Returns an open connection, reusing an idle one if possible.
+
+        @returns paramiko.SSHClient
+
+        """
+        with self._lock:
+            while self._idle:
+                client = self._idle.pop()
+                transport = client.get_transport()
+                if transport and transport.is_active():
+                    return client
+                client.close()
+        return self.ssh._connect()
+
+    def _release(self, client):
+        """
+        Keeps a connection for reuse or closes it if enough are kept.
+
+        @param client - paramiko.SSHClient
+
+        """
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(client)
+                return
+        client.close()
+
+    def _open(self, cmd):
+        """
+        Opens a session for a command on a pooled connection, retrying on
+        new connections.
+
+        @param cmd - String command the session is for
+        @returns Tuple (paramiko.SSHClient, paramiko.Channel)
+
+        """
+        attempt = 0
+        while True:
+            client = None
+            try:
+                client = self._acquire()
+                return client, client.get_transport().open_session()
+            except Exception:
+                if client:
+                    client.close()
+                if attempt >= self.retries:
+                    raise
+                wait = self.backoff * 2 ** attempt
+                logger.warning("Connection failed, retrying in %s seconds: "
+                               "%s" % (wait, cmd))
+                time.sleep(wait)
+                attempt += 1
+
+    def exec_once(self, cmd):
+        """
+        Executes a command on a pooled connection.
+
+        @param cmd - String command to execute.
+        @return Two tuple comprised of the return code and stdout
+
+        """
+        client, chan = self._open(cmd)
+        try:
+            result = self.ssh._run(chan, cmd)
+        except Exception:
+            client.close()
+            raise
+        self._release(client)
+        return result
+
+    def exec_lines(self, cmd):
+        """
+        Executes a command on a pooled connection and yields its stdout
+        one line at a time as it arrives. The connection is kept for reuse
+        if all of the output was read, and closed otherwise.
+
+        @param cmd - String command to execute.
+        @yields - String line
+        @raises Exception if the command returns a non zero return code
+
+        """
+        client, chan = self._open(cmd)
+        retcode = None
+        try:
+            logger.debug("Executing: %s" % cmd)
+            chan.exec_command(cmd)
+            for line in chan.makefile('r'):
+                yield line
+            retcode = chan.recv_exit_status()
+        finally:
+            if retcode is None:
+                client.close()
+            else:
+                self._release(client)
+        if retcode:
+            raise Exception("Command returned %s: %s" % (retcode, cmd))
+
+    def close(self):
+        """
+        Closes the idle connections.
+
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for client in idle:
+            client.close()
+
+
+class ReviewQueue(StoppableThread):
+    """
+    Posts review messages in the background so callers do not wait on
+    gerrit. Messages waiting for the same revision are combined into one
+    review. Reviews go out over an SSHPool. Messages still waiting when
+    the thread is stopped are sent before it exits.
+
+    """
+    def __init__(self, pool, linger=0.5):
+        """
+        Inits the queue. Call start to begin sending.
+
+        @param pool - SSHPool to the gerrit the reviews are posted to
+        @param linger - Float seconds to wait for more messages once a
+            message arrives
+
+        """
+        super(ReviewQueue, self).__init__()
+        self.daemon = True
+        self.pool = pool
+        self.linger = linger
+        self.sent = 0
+        self.failed = 0
+        self._pending = collections.OrderedDict()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        """
+        Returns the number of revisions with waiting messages.
+
+        @returns Integer
+
+        """
+        return len(self._pending)
+
+    def post(self, revision, message, callback=None):
+        """
+        Queues a review message.
+
+        @param revision - String revision to comment on
+        @param message - String message
+        @param callback - Function called without arguments once the
+            message was posted. Not called if posting failed.
+
+        """
+        with self._cond:
+            self._pending.setdefault(revision, []).append((message, callback))
+            self._cond.notify()
+
+    def _send(self, revision, messages):
+        """
+        Posts the messages for a revision as one review, then calls the
+        callbacks of the messages if it was posted.
+
+        @param revision - String revision
+        @param messages - List of (message, callback) tuples
+
+        """
+        message = '\n\n'.join(m for m, _ in messages)
+        cmd = 'gerrit review -m %s %s' % (pipes.quote(message), revision)
+        try:
+            retcode, _ = self.pool.exec_once(cmd)
+        except Exception:
+            logger.exception("Revision %s: Unable to post review" % revision)
+            self.failed += 1
+            return
+        if retcode:
+            logger.error("Revision %s: gerrit review returned %s"
+                         % (revision, retcode))
+            self.failed += 1
+            return
+        self.sent += 1
+        for _, callback in messages:
+            if callback is None:
+                continue
+            try:
+                callback()
+            except Exception:
+                logger.exception("Revision %s: Review callback failed"
+                                 % revision)
+
+    def run(self):
+        """
+        Run loop of the thread. Waits for messages, lingers so messages
+        for the same revision can be combined, then posts everything
+        waiting.
+
+        """
+        while True:
+            with self._cond:
+                if not self._pending:
+                    if self._stop.isSet():
+                        break
+                    self._cond.wait(1)
+                    continue
+
+            if not self._stop.isSet():
+                time.sleep(self.linger)
+
+            with self._cond:
+                pending = self._pending
+                self._pending = collections.OrderedDict()
+
+            for revision, messages in pending.iteritems():
+                self._send(revision, messages)
+            logger.debug("Reviews posted: %s, failed: %s"
+                         % (self.sent, self.failed))
+
+    def close(self):
+        """
+        Stops the thread after the waiting messages are sent.
+
+        """
+        self.stop()
+        if self.is_alive():
+            self.join()
+
 
 class Remote(object):
     """
@@ -218,14 +547,16 @@ class Remote(object):
     methods to create SSH and Event streams
 
     """
-    def __init__(self, _config):
+    def __init__(self, _config, name=None):
         """
         Inits the remote.
 
         @param _config - Dictionary containing keys for host, port, timeout,
             username, key_filename, and keepalive
+        @param name - String name of the remote in the configuration
 
         """
+        self.name = name
         self.host = _config['host']
         self.port = _config['port']
         self.timeout = _config['timeout']
@@ -233,10 +564,12 @@ class Remote(object):
         self.key_filename = _config['key_filename']
         self.keepalive = _config['keepalive']
 
-    def SSHStream(self):
+    def SSHStream(self, types=None):
         """
         Returns a gerrit.SSHStream object
 
+        @param types - List of event types to subscribe to. None for all
+            events.
         @returns - gerrit.SSHStream
 
         """
@@ -246,9 +579,23 @@ class Remote(object):
             self.timeout,
             self.username,
             self.key_filename,
-            self.keepalive
+            self.keepalive,
+            types=types
         )
 
+    def url(self, project, username=None):
+        """
+        Returns the ssh git url of a project on this remote.
+
+        @param project - String project name
+        @param username - String username to use instead of the
+            configured username
+        @returns - String
+
+        """
+        return 'ssh://%s@%s:%s/%s' % (username or self.username, self.host,
+                                      self.port, project)
+
     def SSH(self):
         """
         Returns a gerrit.SSH object
@@ -263,22 +610,66 @@ class Remote(object):
             self.key_filename
         )
 
+    def _key(self):
+        """
+        Returns the connection info identifying this remote.
+
+        @returns - Tuple
+
+        """
+        return (self.host, int(self.port), self.username, self.key_filename)
+
+    def SSHPool(self):
+        """
+        Returns the process wide gerrit.SSHPool of this remote
+
+        @returns - gerrit.SSHPool
+
+        """
+        with _registry_lock:
+            pool = _ssh_pools.get(self._key())
+            if pool is None:
+                pool = SSHPool(self.SSH())
+                _ssh_pools[self._key()] = pool
+        return pool
+
+    def ReviewQueue(self):
+        """
+        Returns the process wide, running gerrit.ReviewQueue posting
+        reviews to this remote
+
+        @returns - gerrit.ReviewQueue
+
+        """
+        pool = self.SSHPool()
+        with _registry_lock:
+            queue = _review_queues.get(self._key())
+            if queue is None or not queue.is_alive():
+                queue = ReviewQueue(pool)
+                queue.start()
+                atexit.register(queue.close)
+                _review_queues[self._key()] = queue
+        return queue
+
 
 class Approval(object):
     """
     Models a gerrit approval.
-    Should have fields for type, description, value, granted on and
-    granted by
+    Only the label name and value are kept, parsed when the approval is
+    created.
 
     """
+    __slots__ = ('_name', '_value')
+
     def __init__(self, data):
         """
-        Sets the data for the approval.
+        Parses the data of the approval.
 
         @param data - Dictionary containing approval data
 
         """
-        self._data = data
+        self._name = utils.intern_string(data.get('type'))
+        self._value = int(data.get('value'))
 
     @property
     def name(self):
@@ -288,7 +679,7 @@ class Approval(object):
         @returns string|None
 
         """
-        return self._data.get('type')
+        return self._name
 
     @property
     def value(self):
@@ -297,14 +688,340 @@ class Approval(object):
 
         @returns Integer
         """
-        return int(self._data.get('value'))
+        return self._value
+
+
+class Change(object):
+    """
+    Models a change returned by gerrit query.
+
+    """
+    def __init__(self, data):
+        """
+        Sets the data for the change.
+
+        @param data - Dictionary containing change data
+
+        """
+        self._data = data
+
+    @property
+    def id(self):
+        """
+        Returns the Change-Id
+
+        @returns - String
+
+        """
+        return self._data.get('id')
+
+    @property
+    def number(self):
+        """
+        Returns the change number
+
+        @returns - Integer
+
+        """
+        return int(self._data['number'])
+
+    @property
+    def project(self):
+        """
+        Returns the project name
+
+        @returns - String
+
+        """
+        return self._data.get('project')
+
+    @property
+    def branch(self):
+        """
+        Returns the branch name
+
+        @returns - String
+
+        """
+        return self._data.get('branch')
+
+    @property
+    def topic(self):
+        """
+        Returns the topic name or None if the change has no topic
+
+        @returns - String | None
+
+        """
+        return self._data.get('topic')
+
+    @property
+    def status(self):
+        """
+        Returns the status(NEW, MERGED, ABANDONED)
+
+        @returns - String
+
+        """
+        return self._data.get('status')
+
+    @property
+    def url(self):
+        """
+        Returns the url of the change
+
+        @returns - String | None
+
+        """
+        return self._data.get('url')
+
+    @property
+    def current_patch_set(self):
+        """
+        Returns the current patch set. Needs the current-patch-set field.
+
+        @returns - Dictionary | None
+
+        """
+        return self._data.get('currentPatchSet')
+
+    @property
+    def patch_sets(self):
+        """
+        Returns all patch sets. Needs the patch-sets or all-approvals field.
+
+        @returns - List of dictionaries
+
+        """
+        return self._data.get('patchSets', [])
+
+    def patch_set(self, number):
+        """
+        Returns the patch set with number or None.
+
+        @param number - Integer patch set number
+        @returns - Dictionary | None
+
+        """
+        for patch_set in self.patch_sets:
+            if int(patch_set['number']) == number:
+                return patch_set
+        current = self.current_patch_set
+        if current and int(current['number']) == number:
+            return current
+        return None
+
+    def approvals(self, number=None):
+        """
+        Returns the approvals of a patch set.
+
+        @param number - Integer patch set number. The current patch set if
+            None.
+        @returns - List of Approval
+
+        """
+        if number is None:
+            patch_set = self.current_patch_set
+        else:
+            patch_set = self.patch_set(number)
+        if not patch_set:
+            return []
+        return [Approval(a) for a in patch_set.get('approvals', [])]
+
+
+class Query(object):
+    """
+    Runs a gerrit query and yields Change objects as results are iterated.
+    Results are fetched a page at a time, resuming with --start or, for
+    older gerrits, with resume_sortkey. Optional fields are only requested
+    when asked for. A query can be split into shards, such as projects or
+    age ranges, that are fetched in parallel.
+
+    """
+    FIELDS = {
+        'current-patch-set': '--current-patch-set',
+        'patch-sets': '--patch-sets',
+        'all-approvals': '--all-approvals',
+        'files': '--files',
+        'comments': '--comments',
+        'commit-message': '--commit-message',
+        'dependencies': '--dependencies',
+        'submit-records': '--submit-records'
+    }
+
+    def __init__(self, ssh, query, fields=None, limit=None, page_size=500,
+                 resume='start', shards=None, jobs=4):
+        """
+        Inits the query. Nothing is run until the results are iterated.
+
+        @param ssh - gerrit.SSH or gerrit.SSHPool to run the query with
+        @param query - String gerrit query
+        @param fields - List of optional fields. See FIELDS.
+        @param limit - Integer maximum number of results or None
+        @param page_size - Integer number of results per page
+        @param resume - String 'start' or 'sortkey'
+        @param shards - List of query terms splitting the query, or None
+        @param jobs - Integer number of shards to fetch at once
+
+        """
+        unknown = set(fields or []) - set(self.FIELDS)
+        if unknown:
+            raise ValueError("Unknown query fields: %s"
+                             % ', '.join(sorted(unknown)))
+        self.ssh = ssh
+        self.query = query
+        self.fields = fields or []
+        self.limit = limit
+        self.page_size = page_size
+        self.resume = resume
+        self.shards = shards
+        self.jobs = jobs
+
+    def command(self, query, page, start=0, sortkey=None):
+        """
+        Returns the gerrit query command for a page.
+
+        @param query - String query
+        @param page - Integer number of results
+        @param start - Integer number of results to skip
+        @param sortkey - String sort key to resume after or None
+        @returns - String
+
+        """
+        terms = '%s limit:%d' % (query, page)
+        args = ['gerrit query --format JSON']
+        args += [self.FIELDS[f] for f in sorted(self.fields)]
+        if self.resume == 'sortkey':
+            if sortkey:
+                terms = '%s resume_sortkey:%s' % (terms, sortkey)
+        elif start:
+            args.append('--start %d' % start)
+        args.append(pipes.quote(terms))
+        return ' '.join(args)
+
+    def pages(self, shard=None):
+        """
+        Yields the results of the query, narrowed by shard, fetching a page
+        at a time.
+
+        @param shard - String query terms or None
+        @yields - Change
+
+        """
+        query = '%s %s' % (self.query, shard) if shard else self.query
+        start = 0
+        sortkey = None
+        while True:
+            page = self.page_size
+            if self.limit is not None:
+                page = min(page, self.limit - start)
+            if page <= 0:
+                return
+
+            # Rows are decoded as they arrive instead of buffering the page
+            cmd = self.command(query, page, start=start, sortkey=sortkey)
+            rows = utils.MultiJSON(self.ssh.exec_lines(cmd))
+            count = 0
+            try:
+                for row in rows:
+                    count += 1
+                    sortkey = row.get('sortKey', sortkey)
+                    yield Change(row)
+
+                # Newer gerrits say whether there are more results
+                stats = rows.stats or {}
+            finally:
+                rows.close()
+            if not count or not stats.get('moreChanges', count >= page):
+                return
+            start += count
+
+    def _fetch_shard(self, shard, results, cancel):
+        """
+        Puts the results of a shard on results followed by None. Puts the
+        exception instead if the shard fails.
+
+        @param shard - String query terms
+        @param results - Queue.Queue
+        @param cancel - threading.Event set when results are not wanted
+        @returns - Boolean
+
+        """
+        def put(item):
+            while not cancel.isSet():
+                try:
+                    results.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        try:
+            for change in self.pages(shard):
+                if not put(change):
+                    return
+        except Exception as e:
+            logger.exception("Error running query shard %s" % shard)
+            put(e)
+        put(None)
+
+    def __iter__(self):
+        """
+        Iterate over the results
+
+        @yields - Change
+
+        """
+        if not self.shards:
+            for change in self.pages():
+                yield change
+            return
+
+        results = Queue.Queue(self.page_size)
+        cancel = threading.Event()
+        pool = WorkerPool(min(self.jobs, len(self.shards)))
+        for shard in self.shards:
+            pool.add_task(self._fetch_shard, shard, results, cancel)
+
+        # Shards may overlap while changes age across their bounds
+        seen = set()
+        remaining = len(self.shards)
+        try:
+            while remaining:
+                item = results.get()
+                if item is None:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                elif item.number not in seen:
+                    seen.add(item.number)
+                    yield item
+                    if self.limit is not None and len(seen) >= self.limit:
+                        return
+        finally:
+            cancel.set()
+            pool.stop()
+
+    def first(self):
+        """
+        Returns the first result or None if there are no results.
+
+        @returns - Change | None
+
+        """
+        for change in self:
+            return change
+        return None
 
 
 class Label(object):
     """
-    Models a gerrit label
+    Models a gerrit label. Only the running lowest and highest votes are
+    kept.
 
     """
+    __slots__ = ('name', '_min', '_max', '_low', '_high')
+
     def __init__(self, name, min_, max_):
         """
         Inits the label. Add values and use the pass method to determine
@@ -318,7 +1035,8 @@ class Label(object):
         self.name = name
         self._min = min_
         self._max = max_
-        self._values = []
+        self._low = None
+        self._high = None
 
     def add_approval(self, approval):
         """
@@ -329,7 +1047,10 @@ class Label(object):
         """
         value = approval.value
         logger.debug("Adding value %s to label %s" % (value, self.name))
-        self._values.append(value)
+        if self._low is None or value < self._low:
+            self._low = value
+        if self._high is None or value > self._high:
+            self._high = value
 
     def approved(self):
         """
@@ -342,15 +1063,15 @@ class Label(object):
 
         """
         # Fail if no values
-        if not self._values:
+        if self._high is None:
             return False
 
         # Fail if we have the lowest possible value
-        if min(self._values) <= self._min:
+        if self._low <= self._min:
             return False
 
         # Pass if we have the highest value
-        if max(self._values) >= self._max:
+        if self._high >= self._max:
             return True
 
         # Fail otherwise
@@ -361,17 +1082,38 @@ class CommentAdded(object):
     """
     Models CommentAdded type gerrit events.
     Provides ability to send upstream if criteria is met.
+    The fields used are parsed once when the event is created and the raw
+    event is not kept.
 
     """
+    __slots__ = ('_conf', '_comment', '_change_id', '_patchset_id',
+                 '_project', '_branch', '_topic', '_number', '_revision',
+                 '_parents', '_uploader', '_author')
+
     def __init__(self, data, conf):
         """
         Inits the object.
 
         @param data - Dictionary
-        @param conf - Dictionary
+        @param conf - config.Config
         """
-        self._data = data
+        change = data['change']
+        patch_set = data['patchSet']
+        uploader = patch_set.get('uploader', {})
+        author = data.get('author', {})
         self._conf = conf
+        self._comment = data.get('comment', '')
+        self._change_id = change.get('id')
+        self._patchset_id = int(patch_set.get('number'))
+        self._project = utils.intern_string(change['project'])
+        self._branch = utils.intern_string(change['branch'])
+        self._topic = change.get('topic')
+        self._number = int(change['number'])
+        self._revision = patch_set['revision']
+        self._parents = tuple(patch_set.get('parents', ()))
+        self._uploader = (uploader.get('username'), uploader.get('name'),
+                          uploader.get('email'))
+        self._author = (author.get('name'), author.get('email'))
 
     @property
     def comment(self):
@@ -381,7 +1123,7 @@ class CommentAdded(object):
         @returns - String
 
         """
-        return self._data.get('comment', '')
+        return self._comment
 
     @property
     def change_id(self):
@@ -391,7 +1133,7 @@ class CommentAdded(object):
         @returns - String
 
         """
-        return self._data['change'].get('id')
+        return self._change_id
 
     @property
     def patchset_id(self):
@@ -401,7 +1143,7 @@ class CommentAdded(object):
         @returns - Integer
 
         """
-        return int(self._data['patchSet'].get('number'))
+        return self._patchset_id
 
     @property
     def project(self):
@@ -411,7 +1153,7 @@ class CommentAdded(object):
         @returns - String
 
         """
-        return self._data['change']['project']
+        return self._project
 
     @property
     def branch(self):
@@ -421,17 +1163,39 @@ class CommentAdded(object):
         @returns - String
 
         """
-        return self._data['change']['branch']
+        return self._branch
 
     @property
     def topic(self):
         """
-        Returns the topic name
+        Returns the topic name or None if the change has no topic
+
+        @returns - String | None
+
+        """
+        return self._topic
+
+    @property
+    def number(self):
+        """
+        Returns the change number
+
+        @returns - Integer
+
+        """
+        return self._number
+
+    @property
+    def ref(self):
+        """
+        Returns the ref of the patchset on downstream gerrit,
+        refs/changes/<last two digits>/<change number>/<patchset number>
 
         @returns - String
 
         """
-        return self._data['change']['topic']
+        return 'refs/changes/%02d/%d/%d' % (self.number % 100, self.number,
+                                            self.patchset_id)
 
     @property
     def revision(self):
@@ -441,7 +1205,17 @@ class CommentAdded(object):
         @returns - String
 
         """
-        return self._data['patchSet']['revision']
+        return self._revision
+
+    @property
+    def parents(self):
+        """
+        Returns the revisions of the parents of the patch set
+
+        @returns - Tuple of strings
+
+        """
+        return self._parents
 
     @property
     def patchset_uploader_username(self):
@@ -451,7 +1225,7 @@ class CommentAdded(object):
         @returns - String | None
 
         """
-        return self._data['patchSet']['uploader'].get('username')
+        return self._uploader[0]
 
     @property
     def patchSet_uploader_name(self):
@@ -461,7 +1235,7 @@ class CommentAdded(object):
         @returns - String | None
 
         """
-        return self._data['patchSet']['uploader'].get('name')
+        return self._uploader[1]
 
     @property
     def patchset_uploader_email(self):
@@ -471,7 +1245,7 @@ class CommentAdded(object):
         @returns - String | None
 
         """
-        return self._data['patchSet']['uploader'].get('email')
+        return self._uploader[2]
 
     def is_upstream_project(self):
         """
@@ -482,13 +1256,7 @@ class CommentAdded(object):
         @returns Boolean
 
         """
-        project = None
-
-        # Iterate over projects in config looking for one with a matching name
-        for p in self._conf.get('projects', []):
-            if p.get('name') == self.project:
-                project = Project(p)
-                break
+        project = self._conf.project(self.project)
 
         # If project not set, then project wasn't found
         if not project:
@@ -515,10 +1283,11 @@ class CommentAdded(object):
             false otherwise.
 
         """
-        trigger = self._conf['upstream']['trigger']
-        logger.debug("Change %s: Trigger '%s'" % (self.change_id, trigger))
+        trigger = self._conf.trigger(self.project)
+        logger.debug("Change %s: Trigger '%s'"
+                     % (self.change_id, trigger.pattern))
         first_line = self.comment.splitlines()[0]
-        return (trigger in first_line) or self.is_forced()
+        return bool(trigger.search(first_line)) or self.is_forced()
 
     def is_forced(self):
         """
@@ -535,15 +1304,15 @@ class CommentAdded(object):
         line.
         """
         labels = get_labels_for_upstream(self._conf, self.project)
+        values = dict((name, []) for name in labels)
 
         for approval in approvals:
-            label = labels.get(approval.name)
-            if label:
-                label.add_approval(approval)
+            if approval.name in values:
+                values[approval.name].append(approval.value)
 
         formatted_string = ''
         for label in labels.values():
-            formatted_string += '%s: %s\n' % (label.name, label._values)
+            formatted_string += '%s: %s\n' % (label.name, values[label.name])
 
         return formatted_string
 
@@ -608,33 +1377,23 @@ class CommentAdded(object):
         """
         Returns a list of approvals or the empty list for the change
 
-        @param ssh - gerrit.SSH object
+        @param ssh - gerrit.SSH or gerrit.SSHPool object
         @returns - List of approvals
         """
         approvals = []
-        cmd = ('gerrit query change:%s branch:%s project:%s'
-               ' --all-approvals limit:1 --format JSON')
-        cmd = cmd % (self.change_id, self.branch, self.project)
+        query = Query(ssh, 'change:%s branch:%s project:%s'
+                      % (self.change_id, self.branch, self.project),
+                      fields=['all-approvals'], limit=1)
         try:
-            retcode, out = ssh.exec_once(cmd)
-
-            # Raise exception if nonzero retcode.
-            # @TODO - Clean this exception handling up.
-            if retcode:
-                raise Exception("Change %s: Error getting approvals"
-                                % self.change_id)
-
-            # Grab the first json object. Query returns 1+
-            json_ = utils.MultiJSON(out)[0]
-            for patchset in json_['patchSets']:
-                if int(patchset['number']) == self.patchset_id:
-                    for json_approval in patchset['approvals']:
-                        logger.debug(pprint.pformat(json_approval))
-                        approvals.append(Approval(json_approval))
+            change = query.first()
+            if change is None:
+                raise Exception("Change %s: Not found" % self.change_id)
+            approvals = change.approvals(self.patchset_id)
 
             logger.debug("Change %s: Approvals returned by gerrit query"
                          % self.change_id)
-            logger.debug(pprint.pformat(json_))
+            for approval in approvals:
+                logger.debug("%s: %s" % (approval.name, approval.value))
 
         except:
             logger.exception("Change %s: Error getting approvals"
@@ -643,196 +1402,331 @@ class CommentAdded(object):
         # Return approvals or empy list
         return approvals
 
-    def get_upstream_url(self, upstream):
+    def ledger_key(self, ledger):
         """
-        Attempts to get the upstream url for this change.
-        This change should have already been pushed upstream.
+        Returns the key of this patch set in a ledger.
 
-        @param upstream - gerrit.Remote
-        @returns - None | String. Url for success, None otherwise
+        @param ledger - state.Ledger
+        @returns - String
 
         """
-        ssh = upstream.SSH()
-        cmd = 'gerrit query change:%s branch:%s project:%s --format JSON'
-        cmd = cmd % (self.change_id, self.branch, self.project)
-        url = None
-        try:
-            retcode, out = ssh.exec_once(cmd)
-            # Check retcode
-            if retcode:
-                return None
+        return ledger.key(self.number, self.patchset_id, self.revision)
 
-            if not retcode:
-                json_ = utils.MultiJSON(out)
-                # Check that a match was found. A stats object will always
-                # be sent. need length > 1
-                if len(json_) < 2:
-                    return None
-                url = json_[0]['url']
-        except Exception:
-            logger.exception("Exception getting upstream url")
-
-        # Backup url
-        if not url:
-            url = ("https://%s/#q,%s,n,z" % (upstream.host, self.change_id))
-        return url
-
-    def send_upstream(self, downstream, upstream):
+    def ready(self, downstream, ledger=None):
         """
-        Sends the change indicated by the comment upstream.
+        Returns whether or not the patch set should be sent upstream.
+        Reports unmet approvals downstream. With a ledger, skips patch sets
+        that were sent or are being sent and claims the send.
 
         @param downstream - gerrit.Remote downstream object
-        @param upstream - gerrit.Remote upstream object
+        @param ledger - state.Ledger of sends or None
+        @returns - Boolean
 
         """
 
         # Check if upstream project before doing anything.
         if not self.is_upstream_project():
-            return
+            return False
 
-        ssh = downstream.SSH()
+        reviews = downstream.ReviewQueue()
 
         # Check to see if comment indicates a change is upstream ready
         if not self.is_upstream_indicated():
             logger.debug("Change %s: Upstream not indicated" % self.change_id)
-            return
+            return False
+
+        # Skip patch sets that were already sent or are being sent
+        if ledger:
+            entry = ledger.lookup(self.ledger_key(ledger))
+            if entry:
+                logger.info("Change %s: Patch set %s is already %s upstream."
+                            % (self.change_id, self.patchset_id,
+                               entry['status']))
+                return False
 
         # Grab all of the approvals
-        approvals = self.get_approvals(downstream.SSH())
+        approvals = self.get_approvals(downstream.SSHPool())
 
         # Check to see if comment has necessary approvals.
         if self.is_forced():
             if not self.is_release_approved(approvals):
                 msg = "Could not send to upstream: Release not approved."
                 logger.debug("Change %s: %s" % (self.change_id, msg))
-                ssh.exec_once('gerrit review -m %s %s'
-                              % (pipes.quote(msg), self.revision))
-                return
+                reviews.post(self.revision, msg)
+                return False
             msg = ("%s (%s) has requested a forced upstream push. "
                    "Bypassing all votes except for Release...\n\n "
                    "Current votes are:\n\n%s"
-                   % (self._data['author']['name'],
-                      self._data['author']['email'],
+                   % (self._author[0], self._author[1],
                       self.stringify_approvals(approvals)))
             logger.debug("Change %s: %s" % (self.change_id, msg))
-            ssh.exec_once('gerrit review -m %s %s'
-                          % (pipes.quote(msg), self.revision))
+            reviews.post(self.revision, msg)
         else:
             if not self.is_upstream_approved(approvals):
                 msg = ("Could not send to upstream: One or more labels"
                        " not approved.")
                 logger.debug("Change %s: %s" % (self.change_id, msg))
-                ssh.exec_once('gerrit review -m %s %s'
-                              % (pipes.quote(msg), self.revision))
-                return
+                reviews.post(self.revision, msg)
+                return False
 
-        # Do some git stuffs to push upstream
-        logger.debug("Change %s: Sending to upstream" % self.change_id)
+        if ledger and not ledger.claim(self.ledger_key(ledger)):
+            logger.info("Change %s: Patch set %s is already being sent."
+                        % (self.change_id, self.patchset_id))
+            return False
+        return True
 
-        repo_dir = '~/tmp'
-        repo_dir = os.path.expanduser(repo_dir)
-        repo_dir = os.path.abspath(repo_dir)
 
-        # Add uuid, want a unique directory here
-        uuid_dir = str(uuid4())
-        repo_dir = os.path.join(repo_dir, uuid_dir)
+def find_upstream_changes(upstream, project, branch, change_ids):
+    """
+    Looks up changes on upstream with a single query.
 
-        # Make Empty directory - We want this to stop and fail on OSError
-        if not os.path.isdir(repo_dir):
-            os.makedirs(repo_dir)
-            logger.debug(
-                "Change %s: Created directory %s" % (self.change_id, repo_dir)
-            )
+    @param upstream - gerrit.Remote
+    @param project - String project name
+    @param branch - String branch name
+    @param change_ids - List of Change-Ids
+    @returns - Dictionary keyed by Change-Id of dictionaries holding the
+        url and the set of patch set revisions of each change found
 
-        try:
-            # Change to newly created directory.
-            os.chdir(repo_dir)
+    """
+    found = {}
+    terms = ' OR '.join('change:%s' % c for c in sorted(set(change_ids)))
+    query = Query(upstream.SSHPool(),
+                  'project:%s branch:%s (%s)' % (project, branch, terms),
+                  fields=['patch-sets'])
+    try:
+        for change in query:
+            found[change.id] = {
+                'url': change.url,
+                'revisions': set(p['revision'] for p in change.patch_sets)
+            }
+    except Exception:
+        logger.exception("Project %s: Error looking up changes upstream"
+                         % project)
+    return found
+
+
+def series(changes):
+    """
+    Splits changes into series that can each be sent with one push. A
+    series is a change no other change descends from, its tip, and the
+    changes it descends from.
+
+    @param changes - List of CommentAdded
+    @returns - List of lists of CommentAdded, tips last
 
-            # Init the cwd
-            git.init()
+    """
+    by_revision = dict((c.revision, c) for c in changes)
+    parents = set(p for c in changes for p in c.parents)
+    result = []
+    for tip in changes:
+        if tip.revision in parents:
+            continue
+        members = []
+        seen = set()
+        todo = [tip]
+        while todo:
+            change = todo.pop()
+            if change.revision in seen:
+                continue
+            seen.add(change.revision)
+            members.append(change)
+            todo.extend(by_revision[p] for p in change.parents
+                        if p in by_revision)
+        result.append(list(reversed(members)))
+    return result
+
+
+def send_changes(conf, downstream, upstream, changes, ledger=None):
+    """
+    Sends patch sets of one project and branch upstream. All patch sets are
+    fetched at once and each series is pushed once. Results are queued as
+    review comments downstream. Patch sets whose fetch or push failed are
+    recorded as failed in the ledger, so the trigger sweep backs off from
+    them. Claims of other patch sets that were not sent are dropped so
+    they can be retried.
+
+    @param conf - config.Config
+    @param downstream - gerrit.Remote downstream object
+    @param upstream - gerrit.Remote upstream object
+    @param changes - List of CommentAdded that are ready
+    @param ledger - state.Ledger or None
 
-            # Add the remotes for upstream and downstream
-            remote_url = "ssh://%s@%s:%s/%s"
-            git.add_remote('downstream', remote_url % (downstream.username,
-                                                       downstream.host,
-                                                       downstream.port,
-                                                       self.project))
+    """
+    if not changes:
+        return
+
+    reviews = downstream.ReviewQueue()
+    sent = set()
+    failed = set()
+
+    def report(change, msg):
+        logger.debug("Change %s: %s" % (change.change_id, msg))
+        reviews.post(change.revision, msg)
+
+    def fail(change, msg):
+        failed.add(change.revision)
+        report(change, msg)
+
+    def finish(change, url):
+        if ledger:
+            ledger.finish(change.ledger_key(ledger), url, {
+                'change_id': change.change_id,
+                'project': change.project,
+                'branch': change.branch,
+                'patchset': change.patchset_id,
+                'revision': change.revision
+            })
+        sent.add(change.revision)
+
+    try:
+        project = changes[0].project
+        branch = changes[0].branch
+
+        # Nothing recorded locally. Make sure upstream does not have them.
+        pending = changes
+        if ledger:
+            found = find_upstream_changes(upstream, project, branch,
+                                          [c.change_id for c in changes])
+            pending = []
+            for change in changes:
+                entry = found.get(change.change_id)
+                if entry and change.revision in entry['revisions']:
+                    finish(change, entry['url'])
+                    report(change, 'Already sent to upstream: %s'
+                           % entry['url'])
+                else:
+                    pending.append(change)
+
+        if pending:
+            pushed = _push_series(conf, downstream, upstream, project,
+                                  branch, pending, fail)
+
+            # Gerrit reports the url of the change it created for single
+            # changes. Look the others up in one query.
+            missing = [m.change_id for members, url in pushed if not url
+                       for m in members]
+            found = {}
+            if missing:
+                found = find_upstream_changes(upstream, project, branch,
+                                              missing)
+            for members, url in pushed:
+                for member in members:
+                    upstream_url = url or found.get(
+                        member.change_id, {}
+                    ).get('url') or ("https://%s/#q,%s,n,z"
+                                     % (upstream.host, member.change_id))
+                    finish(member, upstream_url)
+                    report(member, 'Sent to upstream: %s' % upstream_url)
+    finally:
+        if ledger:
+            backoff = int(conf['sweep']['interval'])
+            for change in changes:
+                if change.revision in sent:
+                    continue
+                if change.revision in failed:
+                    ledger.fail(change.ledger_key(ledger), backoff)
+                else:
+                    ledger.abandon(change.ledger_key(ledger))
+
+
+def _push_series(conf, downstream, upstream, project, branch, changes,
+                 report):
+    """
+    Fetches patch sets from downstream once and pushes each series for
+    review upstream. Failures are reported through report.
+
+    @param conf - config.Config
+    @param downstream - gerrit.Remote downstream object
+    @param upstream - gerrit.Remote upstream object
+    @param project - String project name
+    @param branch - String branch name
+    @param changes - List of CommentAdded
+    @param report - Function taking a change and a message
+    @returns - List of (members, url) tuples for each pushed series. url
+        is the change url gerrit reported or None
+
+    """
+    pushed = []
+    manager = workspace.get_manager(conf)
+    repo_dir = manager.acquire(project)
+    # A workspace left by a failed git command is in an unknown state
+    healthy = False
+    try:
+        # Borrow objects from the local mirror of downstream so the
+        # fetch only transfers the new patch sets.
+        repo_cache = cache.get_cache(conf)
+        if repo_cache:
+            try:
+                repo_cache.borrow(project, downstream.url(project), repo_dir)
+            except Exception:
+                logger.exception("Project %s: Unable to use mirror" % project)
+
+        try:
+            # Fetch exactly the patch sets from downstream
+            git.fetch(downstream.url(project), [c.ref for c in changes],
+                      cwd=repo_dir)
+        except subprocess.CalledProcessError as e:
+            for change in changes:
+                report(change, "Could not send to upstream:\n%s" % e.output)
+            logger.error("Project %s: Unable to fetch from downstream:\n%s"
+                         % (project, e.output))
+            return pushed
+        except Exception:
+            for change in changes:
+                report(change, 'Could not send to upstream: Error running git')
+            logger.exception("Project %s: Unable to fetch from downstream"
+                             % project)
+            return pushed
+
+        batches = series(changes)
+        for members in batches:
+            tip = members[-1]
 
             # Figure out what user we will pose as
             # This every upstream user sharing the same key is kinda shady.
             # Default back to the configured user if username doesnt exist.
             # should fail in this case
-            username = self.patchset_uploader_username
-            name = self.patchSet_uploader_name
-            email = self.patchset_uploader_email
+            username = tip.patchset_uploader_username
             if not username:
                 logger.debug("Change %s: Unable to use author credentials."
                              " Defaulting to configured credentials."
-                             % self.change_id)
+                             % tip.change_id)
                 username = upstream.username
-                name = self._conf['git-config']['name']
-                email = self._conf['git-config']['email']
-
-            git.add_remote('upstream', remote_url % (username,
-                                                     upstream.host,
-                                                     upstream.port,
-                                                     self.project))
-            logger.debug('Change %s: Sending upstream as '
-                         'username %s, email %s, name %s'
-                         % (self.change_id, username, email, name))
+
+            logger.debug('Change %s: Sending %s change(s) upstream as'
+                         ' username %s' % (tip.change_id, len(members),
+                                           username))
             try:
-                env = get_review_env()
-
-                # Set committer info
-                git.set_config('user.email', email)
-                git.set_config('user.name', name)
-
-                # Download  specific change to local
-                args = ['git-review', '-r', 'downstream', '-d',
-                        '%s,%s' % (self.change_id, self.patchset_id)]
-                logger.debug('Change %s: running: %s'
-                             % (self.change_id, ' '.join(args)))
-                out = subprocess.check_output(args,
-                                              stderr=subprocess.STDOUT,
-                                              env=env)
-                logger.debug("Change %s: %s" % (self.change_id, out))
-
-                # Send downloaded change to upstream
-                args = ['git-review', '-R', '-y', '-r', 'upstream',
-                        self.branch, '-t', self.topic]
-                logger.debug('Change %s: running: %s'
-                             % (self.change_id, ' '.join(args)))
-                out = subprocess.check_output(args,
-                                              stderr=subprocess.STDOUT,
-                                              env=env)
-                logger.debug("Change %s: %s" % (self.change_id, out))
-
-                upstream_url = self.get_upstream_url(upstream)
-
-                msg = 'Sent to upstream: %s' % (upstream_url)
-                # Send comment to downstream gerrit with link to change in
-                # upstream gerrit
-                ssh.exec_once('gerrit review -m %s %s'
-                              % (pipes.quote(msg), self.revision))
+                # Push the whole series for review upstream in a single push
+                out = git.push_for_review(
+                    upstream.url(project, username=username),
+                    tip.revision, branch, topic=tip.topic, cwd=repo_dir
+                )
+                logger.debug("Change %s: %s" % (tip.change_id, out))
+                url = git.review_url(out) if len(members) == 1 else None
+                pushed.append((members, url))
 
             except subprocess.CalledProcessError as e:
-                msg = "Could not send to upstream:\n%s" % e.output
-                ssh.exec_once('gerrit review -m %s %s'
-                              % (pipes.quote(msg), self.revision))
+                for member in members:
+                    report(member, "Could not send to upstream:\n%s"
+                           % e.output)
                 logger.error("Change %s: Unable to send to upstream"
-                             % self.change_id)
-                logger.error("Change %s: %s" % (self.change_id, out))
+                             % tip.change_id)
+                logger.error("Change %s: %s" % (tip.change_id, e.output))
 
             except Exception:
-                msg = 'Could not send to upstream: Error running git-review'
-                ssh.exec_once('gerrit review -m %s %s'
-                              % (pipes.quote(msg), self.revision))
+                for member in members:
+                    report(member,
+                           'Could not send to upstream: Error running git')
                 logger.exception("Change %s: Unable to send to upstream"
-                                 % self.change_id)
-
-        finally:
-            # Attempt to clean up created directory
-            shutil.rmtree(repo_dir)
+                                 % tip.change_id)
+        healthy = len(pushed) == len(batches)
+    finally:
+        if healthy:
+            manager.release(project, workspace.WORK, repo_dir)
+        else:
+            manager.discard(repo_dir)
+    return pushed
 
 
 class Group(object):
@@ -967,7 +1861,7 @@ class Group(object):
             msg = "Group %s: Already exists." % self.name
             logger.info(msg)
             print msg
-            return
+            return True
 
         # Try to create the group
         retcode, __ = ssh.exec_once(self.get_create())
@@ -978,6 +1872,48 @@ class Group(object):
         return True if not retcode else False
 
 
+def group_records(remote):
+    """
+    Lists the groups of a gerrit with a single command.
+
+    @param remote - gerrit.Remote object
+    @returns - Dictionary of group name to the verbose ls-groups line
+    @raises Exception if the groups can not be listed
+
+    """
+    retcode, out = remote.SSH().exec_once('gerrit ls-groups --verbose')
+    if retcode:
+        raise Exception("Unable to list groups: %s" % retcode)
+    records = {}
+    for line in out.splitlines():
+        if line.strip():
+            records[line.split('\t', 1)[0]] = line
+    return records
+
+
+def member_records(remote, group):
+    """
+    Lists the members of a group on a gerrit.
+
+    @param remote - gerrit.Remote object
+    @param group - String group name
+    @returns - Dictionary of username to the ls-members line. Empty if the
+        group does not exist.
+
+    """
+    retcode, out = remote.SSH().exec_once('gerrit ls-members %s'
+                                          % quote(group))
+    records = {}
+    if retcode:
+        return records
+    # The first line names the columns: id, username, full name, email
+    for line in out.splitlines()[1:]:
+        fields = line.split('\t')
+        if len(fields) > 1:
+            records[fields[1]] = line
+    return records
+
+
 class User(object):
     """
     Class that models an internal user. Provides some simple accessor methods
@@ -1244,6 +2180,113 @@ class Project(object):
         """
         return self._data.get('upstream', False)
 
+    @property
+    def poll_interval(self):
+        """
+        Returns the number of seconds between polls of the source by the
+        gerrit-sync daemon or None to use the default interval.
+
+        @returns Integer|None
+
+        """
+        return self._data.get('poll-interval')
+
+    @property
+    def min_interval(self):
+        """
+        Returns the minimum number of seconds between two syncs of this
+        project started by the event daemon or None to use the default.
+
+        @returns Integer|None
+
+        """
+        return self._data.get('min-interval')
+
+    @property
+    def upstream_labels(self):
+        """
+        Returns the project specific labels required before sending
+        upstream or None to use the labels for all projects.
+
+        @returns List|None
+
+        """
+        return self._data.get('upstream-labels')
+
+    @property
+    def trigger(self):
+        """
+        Returns the project specific trigger or None to use the
+        upstream trigger.
+
+        @returns String|None
+
+        """
+        return self._data.get('trigger')
+
+    @property
+    def downstream(self):
+        """
+        Returns the name of the remote this project lives on or None for
+        the gerrit section.
+
+        @returns String|None
+
+        """
+        return self._data.get('downstream')
+
+    @property
+    def upstream_remote(self):
+        """
+        Returns the name of the remote this project is sent to and synced
+        from or None for the upstream section.
+
+        @returns String|None
+
+        """
+        return self._data.get('upstream-remote')
+
+    def fingerprint(self):
+        """
+        Returns a fingerprint of this project's configuration including
+        the contents of its project.config file.
+
+        @returns String
+
+        """
+        contents = None
+        if self.config:
+            try:
+                with open(self.config, 'r') as f:
+                    contents = hashlib.md5(f.read()).hexdigest()
+            except IOError:
+                pass
+        return utils.fingerprint(self._data, contents)
+
+    def remote_state(self, remote):
+        """
+        Returns a fingerprint of the refs this project syncs as seen on
+        the source repo and on gerrit, plus gerrit's refs/meta/config.
+        Only lists refs, so this is much cheaper than a sync.
+
+        @param remote - gerrit.Remote object
+        @returns String
+
+        """
+        source_refs = []
+        if self.source and (self.heads or self.tags):
+            source_refs = git.ls_remote(self.source, **self.ref_kwargs())
+
+        patterns = ['refs/meta/config']
+        if self.heads:
+            patterns.append('refs/heads/*')
+        if self.tags:
+            patterns.append('refs/tags/*')
+        gerrit_refs = git.ls_remote(remote.url(self.name), patterns=patterns)
+
+        return utils.fingerprint(sorted(str(r) for r in source_refs),
+                                 sorted(str(r) for r in gerrit_refs))
+
     def _create(self, ssh):
         """
         Attempts to create a project through gerrit ssh commands.
@@ -1258,6 +2301,9 @@ class Project(object):
     def _config(self, remote, conf, groups):
         """
         Builds the groups file and project.config file for a project.
+        Records the sha of refs/meta/config once it matches the
+        configuration, so updates made by this tool can be told apart from
+        edits made on gerrit.
 
         @param remote - gerrit.Remote object
         @param conf - Dict containing git config information
@@ -1271,49 +2317,20 @@ class Project(object):
         logger.info(msg)
         print msg
 
-        repo_dir = '~/tmp'
-        repo_dir = os.path.expanduser(repo_dir)
-        repo_dir = os.path.abspath(repo_dir)
-
-        uuid_dir = str(uuid4())
-        repo_dir = os.path.join(repo_dir, uuid_dir)
-
-        # Make Empty directory - We want this to stop and fail on OSError
-        logger.debug(
-            "Project %s: Creating directory %s" % (self.name, repo_dir)
-        )
-        os.makedirs(repo_dir)
-
-        # Save the current working directory
-        old_cwd = os.getcwd()
-
-        origin = 'origin'
-
-        try:
-            # Change cwd to that repo
-            os.chdir(repo_dir)
-
-            # Git init empty directory
-            git.init()
-
-            # Add remote origin
-            ssh_url = 'ssh://%s@%s:%s/%s' % (
-                remote.username,
-                remote.host,
-                remote.port,
-                self.name
-            )
-
-            git.add_remote(origin, ssh_url)
-
+        store = state.get_store(conf['state']['file'])
+        manager = workspace.get_manager(conf)
+        with manager.workspace(self.name) as repo_dir:
+            ssh_url = remote.url(self.name)
             print("Git remote is here: %s " % ssh_url)
 
             # Fetch refs/meta/config for project
-            refspec = 'refs/meta/config:refs/remotes/origin/meta/config'
-            git.fetch(origin, refspec)
+            refspec = '+refs/meta/config:refs/remotes/origin/meta/config'
+            git.fetch(ssh_url, refspec, cwd=repo_dir)
 
-            # Checkout refs/meta/config
-            git.checkout_branch('meta/config')
+            # Checkout refs/meta/config, dropping anything left from the
+            # last use of the workspace
+            git.reset_branch('meta/config', 'refs/remotes/origin/meta/config',
+                             cwd=repo_dir)
 
             # Get md5 of existing config
             _file = os.path.join(repo_dir, 'project.config')
@@ -1358,33 +2375,37 @@ class Project(object):
                     f.write(group_contents)
 
                 # Git config user.email
-                git.set_config('user.email', conf['git-config']['email'])
+                git.set_config('user.email', conf['git-config']['email'],
+                               cwd=repo_dir)
 
                 # Git config user.name
-                git.set_config('user.name', conf['git-config']['name'])
+                git.set_config('user.name', conf['git-config']['name'],
+                               cwd=repo_dir)
 
                 # Add groups and project.config
-                git.add(['groups', 'project.config'])
+                git.add(['groups', 'project.config'], cwd=repo_dir)
 
                 # Git commit
-                git.commit(message='Setting up %s' % self.name)
+                git.commit(message='Setting up %s' % self.name, cwd=repo_dir)
+
+                # Record before pushing, the ref-updated event of the push
+                # may be handled before the push returns.
+                store.set('acl', self.name,
+                          git.rev_parse('HEAD', cwd=repo_dir))
 
                 # Git push
-                git.push(origin, refspecs='meta/config:refs/meta/config')
+                git.push(ssh_url, refspecs='meta/config:refs/meta/config',
+                         cwd=repo_dir)
                 logger.info("Project %s: pushed configuration." % self.name)
 
             else:
+                store.set('acl', self.name, git.rev_parse(
+                    'refs/remotes/origin/meta/config', cwd=repo_dir
+                ))
                 msg = "Project %s: config unchanged." % self.name
                 logger.info(msg)
                 print msg
 
-        finally:
-            # Change to old current working directory
-            os.chdir(old_cwd)
-
-            # Attempt to clean up created directory
-            shutil.rmtree(repo_dir)
-
     def ref_kwargs(self):
         """
         Returns dictionary of ref keyword arguments
@@ -1399,11 +2420,13 @@ class Project(object):
             kwargs['tags'] = True
         return kwargs
 
-    def _sync(self, remote):
+    def _sync(self, remote, conf):
         """
         Pushes all normal branches from a source repo to gerrit.
 
         @param remote - gerrit.Remote object
+        @param conf - config.Config
+        @returns Integer bytes fetched from the source or None if not synced
 
         """
         # Only sync if source repo is provided.
@@ -1418,63 +2441,41 @@ class Project(object):
         logger.info(msg)
         print msg
 
-        repo_dir = '~/tmp'
-        repo_dir = os.path.expanduser(repo_dir)
-        repo_dir = os.path.abspath(repo_dir)
-
-        # Make Empty directory - We want this to stop and fail on OSError
-        if not os.path.isdir(repo_dir):
-            os.makedirs(repo_dir)
-            logger.debug(
-                "Project %s: Created directory %s" % (self.name, repo_dir)
-            )
-
-        # Save the current working directory
-        old_cwd = os.getcwd()
-
-        try:
-            # Change cwd to that repo
-            os.chdir(repo_dir)
-
-            uuid_dir = str(uuid4())
-            repo_dir = os.path.join(repo_dir, uuid_dir)
+        manager = workspace.get_manager(conf)
+        with manager.workspace(self.name, workspace.BARE) as repo_dir:
+            before = utils.disk_usage(repo_dir)
 
-            # Do a git clone --bare <source_repo>
-            git.clone(self.source, name=uuid_dir, bare=True)
+            # Bring the workspace up to date with the source. Only objects
+            # the workspace does not have yet are transferred.
+            git.fetch(self.source, ['+refs/heads/*:refs/heads/*',
+                                    '+refs/tags/*:refs/tags/*'],
+                      prune=True, cwd=repo_dir)
 
-            # Change to bare cloned directory
-            os.chdir(uuid_dir)
-
-            # Add remote named gerrit
-            ssh_url = 'ssh://%s@%s:%s/%s' % (
-                remote.username,
-                remote.host,
-                remote.port,
-                self.name
-            )
-            git.add_remote('gerrit', ssh_url)
+            ssh_url = remote.url(self.name)
 
             # Push heads
             if self.heads:
-                kwargs = {'all_': True}
+                kwargs = {'all_': True, 'cwd': repo_dir}
                 if self.force:
                     kwargs['force'] = True
-                git.push('gerrit', **kwargs)
+                git.push(ssh_url, **kwargs)
 
             # Push tags
             if self.tags:
-                kwargs = {'tags': True}
+                kwargs = {'tags': True, 'cwd': repo_dir}
                 if self.force:
                     kwargs['force'] = True
-                git.push('gerrit', **kwargs)
+                git.push(ssh_url, **kwargs)
 
             ref_kwargs = self.ref_kwargs()
 
             # Grab origin refs
-            origin_refset = git.remote_refs('origin', **ref_kwargs)
+            origin_refset = git.remote_refs(self.source, cwd=repo_dir,
+                                            **ref_kwargs)
 
             # Grab gerrit refs
-            gerrit_refset = git.remote_refs('gerrit', **ref_kwargs)
+            gerrit_refset = git.remote_refs(ssh_url, cwd=repo_dir,
+                                            **ref_kwargs)
 
             # Find refs that should be removed.
             prune_refset = gerrit_refset - origin_refset
@@ -1488,10 +2489,7 @@ class Project(object):
                       % (self.name, self.preserve_prefix)
                 logger.debug(msg)
                 print msg
-                heads_prefix = "refs/heads/%s" % self.preserve_prefix
-                tags_prefix = "refs/tags/%s" % self.preserve_prefix
-                keep = lambda ref: not ref.startswith(heads_prefix) and \
-                    not ref.startswith(tags_prefix)
+                keep = lambda ref: not self.is_preserved(ref)
                 prune_refset = filter(keep, prune_refset)
 
             # Prefix each ref in refset with ':' to delete
@@ -1500,14 +2498,101 @@ class Project(object):
 
             # Remove branches no longer needed
             if prune_refset:
-                git.push('gerrit', refspecs=prune_refset)
+                git.push(ssh_url, refspecs=prune_refset, cwd=repo_dir)
 
-        finally:
-            # Change to old current working directory
-            os.chdir(old_cwd)
+            return max(utils.disk_usage(repo_dir) - before, 0)
 
-            # Attempt to clean up created directory
-            shutil.rmtree(repo_dir)
+    def is_preserved(self, ref):
+        """
+        Returns whether or not a ref on gerrit is kept when it is deleted
+        on the source.
+
+        @param ref - String full ref name
+        @returns - Boolean
+
+        """
+        if self.preserve_prefix == PRESERVE_ALL_BRANCHES:
+            return True
+        if self.preserve_prefix is None:
+            return False
+        return (ref.startswith("refs/heads/%s" % self.preserve_prefix) or
+                ref.startswith("refs/tags/%s" % self.preserve_prefix))
+
+    def sync_refs(self, remote, conf, updates):
+        """
+        Pushes only the refs named by ref updates on the source to gerrit.
+        Each ref on gerrit must still be at the old revision of its update,
+        or already at the new one. Otherwise the project needs a full sync.
+
+        @param remote - gerrit.Remote object
+        @param conf - config.Config
+        @param updates - List of (ref name, old revision, new revision)
+            tuples, oldest first, like the refUpdate of ref-updated events
+        @returns Integer bytes fetched from the source or None if the refs
+            on gerrit diverged
+
+        """
+        if not self.source:
+            return 0
+
+        # Combine updates of the same ref. Branch names of older gerrit
+        # versions lack the refs/heads/ prefix.
+        refs = collections.OrderedDict()
+        for ref, old, new in updates:
+            if not ref.startswith('refs/'):
+                ref = 'refs/heads/%s' % ref
+            if ref in refs:
+                old = refs[ref][0]
+            refs[ref] = (old, new)
+
+        # Only refs this project syncs
+        for ref in refs.keys():
+            if not ((self.heads and ref.startswith('refs/heads/')) or
+                    (self.tags and ref.startswith('refs/tags/'))):
+                del refs[ref]
+        if not refs:
+            return 0
+
+        ssh_url = remote.url(self.name)
+        current = dict(
+            (r.name, r.hash)
+            for r in git.ls_remote(ssh_url, patterns=list(refs))
+        )
+
+        fetch = []
+        push = []
+        for ref, (old, new) in refs.iteritems():
+            old = None if old == NULL_REVISION else old
+            new = None if new == NULL_REVISION else new
+            have = current.get(ref)
+            if have == new:
+                continue
+            if have != old:
+                logger.info("Project %s: %s is at %s on gerrit, expected %s."
+                            % (self.name, ref, have, old))
+                return None
+            if new is not None:
+                fetch.append('+%s:%s' % (ref, ref))
+                push.append('%s:%s' % (ref, ref))
+            elif not self.is_preserved(ref):
+                push.append(':%s' % ref)
+
+        if not push:
+            return 0
+
+        msg = "Project %s: syncing %s from repo %s." % (
+            self.name, ", ".join(refs), self.source
+        )
+        logger.info(msg)
+        print msg
+
+        manager = workspace.get_manager(conf)
+        with manager.workspace(self.name, workspace.BARE) as repo_dir:
+            before = utils.disk_usage(repo_dir)
+            if fetch:
+                git.fetch(self.source, fetch, cwd=repo_dir)
+            git.push(ssh_url, force=self.force, refspecs=push, cwd=repo_dir)
+            return max(utils.disk_usage(repo_dir) - before, 0)
 
     def ensure(self, remote, conf):
         """
@@ -1518,6 +2603,7 @@ class Project(object):
 
         @param remote - gerrit.Remote object
         @param conf - Configuration dictionary
+        @returns Integer bytes fetched from the source or None if not synced
 
         """
         msg = "Project %s: Ensuring present." % self.name
@@ -1538,7 +2624,7 @@ class Project(object):
         self._config(remote, conf, groups)
 
         # Sync with source repo if needed
-        self._sync(remote)
+        return self._sync(remote, conf)
 
 
 def get_groups(remote):
@@ -1608,44 +2694,17 @@ def groups_file_contents(groups, add_system_groups=True):
 
 def get_labels_for_upstream(conf, project_name):
     """
-    Creates dictionary of label objects loaded from the config dictionary.
+    Creates dictionary of label objects from the compiled label policies.
 
-    @param conf - Dictionary configuration
+    @param conf - config.Config
     @param project_name - String name of a project
     @returns Dictionary of labels keyed by name
 
     """
-    label_dicts = None
-
-    # Look for project specific upstream labels.
-    project_dicts = conf.get('projects', [])
-    for project_dict in project_dicts:
-        if project_dict.get('name') == project_name:
-            label_dicts = project_dict.get('upstream-labels', None)
-            break
-
-    if label_dicts is None:
-        label_dicts = conf.get('upstream-labels', [])
-
     label_objs = {}
-    for l in label_dicts:
-        label = Label(l['name'], int(l['min']), int(l['max']))
-        label_objs.update({
-            l['name']: label
-        })
+    for policy in conf.label_policies(project_name):
+        label = Label(policy.name, policy.min, policy.max)
+        label_objs[policy.name] = label
         logger.debug("Adding label %s with min %s and max %s"
                      % (label.name, label._min, label._max))
     return label_objs
-
-
-def get_review_env():
-    """
-    Returns an environment to send to subprocess.Popen when using
-    git review.
-
-    @returns - Env
-    """
-    env = os.environ.copy()
-    env['PATH'] = env.get('PATH', '') + ':/usr/local/bin/'
-    logger.debug("PAth: %s" % env['PATH'])
-    return env
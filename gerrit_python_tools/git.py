@@ -4,11 +4,22 @@ command. Should look into swapping out subprocess for one of the already
 existing python/git libraries.
 
 """
+import atexit
+import os
+import pipes
+import re
+import shutil
 import subprocess
+import tempfile
+import threading
 import log
 
 logger = log.get_logger()
 
+# Multiplexing of the ssh connections git opens. See configure_ssh.
+_ssh = {'multiplex': False, 'persist': 60, 'dir': None}
+_ssh_lock = threading.Lock()
+
 
 class Ref(object):
     """
@@ -24,18 +35,126 @@ class Ref(object):
         return "\t".join([self.hash, self.name])
 
 
-def git_cmd(args):
+def configure_ssh(multiplex=True, persist=60):
+    """
+    Sets up how git connects over ssh. When multiplexing, git commands run
+    ssh with a control master per remote user, host and port, so
+    connections to the same gerrit share one ssh handshake. The control
+    sockets live in a private directory that is removed at exit.
+
+    @param multiplex - Boolean share ssh connections between git commands
+    @param persist - Integer seconds an idle master connection stays open
+
+    """
+    with _ssh_lock:
+        _ssh['multiplex'] = bool(multiplex)
+        _ssh['persist'] = int(persist)
+
+
+def ssh_env():
+    """
+    Returns the environment git commands should run with or None for the
+    inherited environment.
+
+    @returns Dictionary|None
+
+    """
+    if not _ssh['multiplex']:
+        return None
+
+    with _ssh_lock:
+        if _ssh['dir'] is None:
+            _ssh['dir'] = tempfile.mkdtemp(prefix='gpt-ssh-')
+            atexit.register(close_ssh)
+        control_path = os.path.join(_ssh['dir'], '%r@%h:%p')
+
+    # Keep any ssh command the user configured
+    command = os.environ.get('GIT_SSH_COMMAND')
+    if not command:
+        command = pipes.quote(os.environ.get('GIT_SSH', 'ssh'))
+
+    env = dict(os.environ)
+    env['GIT_SSH_COMMAND'] = ' '.join([
+        command,
+        '-o ControlMaster=auto',
+        '-o %s' % pipes.quote('ControlPath=%s' % control_path),
+        '-o ControlPersist=%s' % _ssh['persist']
+    ])
+    return env
+
+
+def close_ssh():
+    """
+    Closes the master connections opened by git commands and removes
+    their control sockets.
+
+    """
+    with _ssh_lock:
+        directory = _ssh['dir']
+        _ssh['dir'] = None
+    if directory is None:
+        return
+
+    with open(os.devnull, 'w') as devnull:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            logger.debug("Closing ssh master %s" % name)
+            # The host is required but unused since the path is explicit
+            subprocess.call(['ssh', '-O', 'exit', '-o',
+                             'ControlPath=%s' % path, 'localhost'],
+                            stdout=devnull, stderr=devnull)
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def git_cmd(args, cwd=None):
     """
     Convenience method to bundle logged git commands with execution of said
     igt commands.
 
     @param args - List or String reprsenting command to send to subprocess
+    @param cwd - String directory to run the command in. Defaults to the
+        current working directory.
+
+    """
+    msg = " ". join(args)
+    print("Issuing git command %s" % msg)
+    logger.debug(msg)
+    subprocess.check_call(args, cwd=cwd, env=ssh_env())
+
+
+def git_output(args, cwd=None):
+    """
+    Like git_cmd but returns the combined stdout and stderr of the command.
+    Raises subprocess.CalledProcessError with the output on failure.
+
+    @param args - List reprsenting command to send to subprocess
+    @param cwd - String directory to run the command in. Defaults to the
+        current working directory.
+    @returns - String
 
     """
     msg = " ". join(args)
     print("Issuing git command %s" % msg)
     logger.debug(msg)
-    subprocess.check_call(args)
+    return subprocess.check_output(args, cwd=cwd, stderr=subprocess.STDOUT,
+                                   env=ssh_env())
+
+
+def rev_parse(rev, cwd=None):
+    """
+    git rev-parse
+    Returns the sha a revision points at.
+
+    Equivalent to:
+        git rev-parse <rev>
+
+    @param rev - String ref or revision
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
+    @returns - String
+
+    """
+    return git_output(['git', 'rev-parse', rev], cwd=cwd).strip()
 
 
 def listify(thing):
@@ -52,16 +171,23 @@ def listify(thing):
     return thing
 
 
-def init():
+def init(bare=False, cwd=None):
     """
-    Equivalent to calling git init. Affects current working directory.
+    Equivalent to calling git init [--bare]. Affects cwd or the current
+    working directory.
+
+    @param bare - Boolean init with the --bare option
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
 
     """
     args = ['git', 'init']
-    git_cmd(args)
+    if bare:
+        args.append('--bare')
+    git_cmd(args, cwd=cwd)
 
 
-def add_remote(name, url):
+def add_remote(name, url, cwd=None):
     """
     git remote add
     Adds a remote to the git repo that should be the current working
@@ -71,32 +197,39 @@ def add_remote(name, url):
 
     @param name = String name of the remote to add
     @param url = String url of the remote repo
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
 
     """
     args = ['git', 'remote', 'add', name, url]
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
     logger.debug("Added remote %s: %s" % (name, url))
 
 
-def fetch(remote, refspecs):
+def fetch(remote, refspecs, prune=False, cwd=None):
     """
     git fetch
     Fetches a list respecs from the specified remote.
 
     Equivalent to:
-        git fetch <remote> <refspec[0]> <refspec[1]> ... <refspec[n]>
+        git fetch [--prune] <remote> <refspec[0]> <refspec[1]> ... <refspec[n]>
 
     @param remote - String name of the remote
     @param refspecs - List of strings that are refspecs
+    @param prune - Boolean remove refs that no longer exist on the remote
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
 
     """
     refspecs = listify(refspecs)
     args = ['git', 'fetch', remote]
+    if prune:
+        args.insert(2, '--prune')
     args = args + refspecs
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def checkout_branch(name, new=False):
+def checkout_branch(name, new=False, cwd=None):
     """
     git checkout
     Checks out a branch. Optionally creates a new branch
@@ -106,15 +239,52 @@ def checkout_branch(name, new=False):
 
     @param name - String name of branch
     @param new - Boolean create a new branch
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
 
     """
     args = ['git', 'checkout', name]
     if new:
         args.insert(2, '-b')
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
+
+
+def reset_branch(name, start_point, cwd=None):
+    """
+    git checkout -f -B
+    Creates or resets a branch to start_point and checks it out, discarding
+    local changes.
+
+    Equivalent to:
+        git checkout -f -B <name> <start_point>
+
+    @param name - String name of branch
+    @param start_point - String ref or sha the branch should point at
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
+
+    """
+    args = ['git', 'checkout', '-f', '-B', name, start_point]
+    git_cmd(args, cwd=cwd)
 
 
-def set_config(name, value):
+def clean(cwd=None):
+    """
+    git clean
+    Removes untracked and ignored files from the working tree.
+
+    Equivalent to:
+        git clean -f -f -d -x -q
+
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
+
+    """
+    args = ['git', 'clean', '-f', '-f', '-d', '-x', '-q']
+    git_cmd(args, cwd=cwd)
+
+
+def set_config(name, value, cwd=None):
     """
     git config
     Sets a git configuration key value pair for the current directory repo
@@ -124,13 +294,15 @@ def set_config(name, value):
 
     @param name - String name of value to set
     @param value - String value
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
 
     """
     args = ['git', 'config', name, value]
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def add(things):
+def add(things, cwd=None):
     """
     git add
     Adds multiple things to staging
@@ -139,16 +311,18 @@ def add(things):
         git add <things[0]> <things[1]> ... <things[2]>
 
     @param things - List of paths to add
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
 
     """
     things = listify(things)
     if isinstance(things, str):
         things = listify(things)
     args = ['git', 'add'] + things
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def commit(message=''):
+def commit(message='', cwd=None):
     """
     git commit
     Commits the staged changes on the current repo
@@ -156,12 +330,16 @@ def commit(message=''):
     Equivalent to:
         git commit -m message
 
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
+
     """
     args = ['git', 'commit', '-m', message]
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def push(remote, all_=False, tags=False, force=False, refspecs=None):
+def push(remote, all_=False, tags=False, force=False, refspecs=None,
+         cwd=None):
     """
     git push
 
@@ -173,6 +351,8 @@ def push(remote, all_=False, tags=False, force=False, refspecs=None):
     @param all_ - Boolean push all HEAD branches
     @param tags - Boolean push all tags
     @param refspecs - List of refspecs to push
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
 
     """
     args = ['git', 'push', remote]
@@ -185,10 +365,46 @@ def push(remote, all_=False, tags=False, force=False, refspecs=None):
     if refspecs:
         refspecs = listify(refspecs)
         args = args + refspecs
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def clone(source, name=None, bare=False):
+def push_for_review(remote, ref, branch, topic=None, cwd=None):
+    """
+    git push to gerrit for review
+
+    Equivalent to:
+        git push <remote> <ref>:refs/for/<branch>[%topic=<topic>]
+
+    @param remote - String name or url of the gerrit remote
+    @param ref - String local ref or sha to push
+    @param branch - String target branch
+    @param topic - String topic or None
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
+    @returns - String output of the push
+
+    """
+    target = 'refs/for/%s' % branch
+    if topic:
+        target = '%s%%topic=%s' % (target, topic)
+    args = ['git', 'push', remote, '%s:%s' % (ref, target)]
+    return git_output(args, cwd=cwd)
+
+
+def review_url(output):
+    """
+    Returns the url of the first change gerrit reports in the output of a
+    push for review or None.
+
+    @param output - String output of git push
+    @returns - String|None
+
+    """
+    match = re.search(r'^remote:\s+(https?://\S+)', output, re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def clone(source, name=None, bare=False, cwd=None):
     """
     git clone
     Clones a repo
@@ -199,6 +415,8 @@ def clone(source, name=None, bare=False):
     @param source - Url to source repo
     @param name - String name of directory to clone into
     @param bare - Boolean clone with the --bare option
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
 
     """
     args = ['git', 'clone', source]
@@ -206,21 +424,25 @@ def clone(source, name=None, bare=False):
         args.append(name)
     if bare:
         args.insert(2, '--bare')
-    git_cmd(args)
+    git_cmd(args, cwd=cwd)
 
 
-def remote_refs(remote, heads=False, tags=False):
+def ls_remote(remote, heads=False, tags=False, patterns=None, cwd=None):
     """
     git ls-remote
-    Parses the output of git ls-remote
+    Parses the output of git ls-remote into Ref objects
 
     Equivalent to
-        git ls-remote [--heads] [--tags] <remote>
+        git ls-remote [--heads] [--tags] <remote> [<patterns>...]
 
     @param remote - String remote name
     @param heads - Boolean look at all heads
     @param tags - Boolean look at all tags
-    @returns - Set of all refs
+    @param patterns - List of ref patterns to limit the output to
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
+    @returns - List of Ref
+    Raises subprocess.CalledProcessError if the remote can not be listed.
 
     """
     args = ['git', 'ls-remote', remote]
@@ -228,6 +450,31 @@ def remote_refs(remote, heads=False, tags=False):
         args.insert(2, '--heads')
     if tags:
         args.insert(2, '--tags')
-    cmd = subprocess.Popen(args, stdout=subprocess.PIPE)
-    s = lambda line: line.rstrip().split("\t")[1]
-    return set(map(s, cmd.stdout))
+    if patterns:
+        args = args + listify(patterns)
+    cmd = subprocess.Popen(args, stdout=subprocess.PIPE, cwd=cwd,
+                           env=ssh_env())
+    out, _ = cmd.communicate()
+    if cmd.returncode:
+        raise subprocess.CalledProcessError(cmd.returncode, " ".join(args))
+    return [Ref(*line.split("\t")) for line in out.splitlines()]
+
+
+def remote_refs(remote, heads=False, tags=False, cwd=None):
+    """
+    git ls-remote
+    Parses the output of git ls-remote
+
+    Equivalent to
+        git ls-remote [--heads] [--tags] <remote>
+
+    @param remote - String remote name
+    @param heads - Boolean look at all heads
+    @param tags - Boolean look at all tags
+    @param cwd - String directory of the repo. Defaults to the
+        current working directory.
+    @returns - Set of all refs
+
+    """
+    refs = ls_remote(remote, heads=heads, tags=tags, cwd=cwd)
+    return set(ref.name for ref in refs)
@@ -0,0 +1,252 @@
+"""
+Registry of the handlers of gerrit stream events. Each handler declares the
+event types it handles, the stream the events come from and optionally a
+predicate on the project and branch of the event. Routes are compiled into
+a dictionary per stream, so dispatching an event is a single lookup. Each
+handler runs on its own queue of the worker pool and keeps its own
+counters.
+
+"""
+import config
+import log
+import threading
+import time
+
+logger = log.get_logger()
+
+# Roles of the remotes events come from
+DOWNSTREAM = config.DOWNSTREAM
+UPSTREAM = config.UPSTREAM
+STREAMS = (DOWNSTREAM, UPSTREAM)
+
+
+def event_target(event):
+    """
+    Returns the project and branch an event is about. For ref-updated
+    events the branch is the full name of the updated ref.
+
+    @param event - Dictionary gerrit event
+    @returns - Tuple (String|None, String|None)
+
+    """
+    if 'refUpdate' in event:
+        ref_update = event['refUpdate']
+        return ref_update.get('project'), ref_update.get('refName')
+    change = event.get('change') or {}
+    return change.get('project'), change.get('branch')
+
+
+class Context(object):
+    """
+    State of the service handlers work with, such as the current
+    configuration. Attributes are replaced by the service as the state
+    changes, so handlers should read them when they run.
+
+    """
+    def __init__(self, **kwargs):
+        """
+        Inits the context.
+
+        @param **kwargs - Attributes of the context
+
+        """
+        self.__dict__.update(kwargs)
+
+
+class Handler(object):
+    """
+    Handles one or more types of events from one stream.
+
+    """
+    def __init__(self, name, types, stream, func, predicate=None,
+                 threads=1):
+        """
+        Inits the handler.
+
+        @param name - String name of the handler. Also names its queue.
+        @param types - List of event type strings(comment-added, etc)
+        @param stream - String DOWNSTREAM or UPSTREAM
+        @param func - Function called with the context and event
+        @param predicate - Function called with the project and branch of
+            an event. Events it returns False for are skipped. None to
+            handle every event.
+        @param threads - Integer number of threads working the queue of
+            the handler
+
+        """
+        if stream not in STREAMS:
+            raise ValueError("Unknown stream %s" % stream)
+        self.name = name
+        self.types = tuple(types)
+        self.stream = stream
+        self.func = func
+        self.predicate = predicate
+        self.threads = int(threads)
+        self.received = 0
+        self.skipped = 0
+        self.handled = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def accepts(self, event):
+        """
+        Returns whether or not the predicate accepts the event. Counts the
+        event as received or skipped.
+
+        @param event - Dictionary gerrit event
+        @returns - Boolean
+
+        """
+        accepted = True
+        if self.predicate is not None:
+            accepted = bool(self.predicate(*event_target(event)))
+        with self._lock:
+            if accepted:
+                self.received += 1
+            else:
+                self.skipped += 1
+        return accepted
+
+    def run(self, context, event):
+        """
+        Calls the handler function and records the outcome. Errors are
+        logged and counted, not raised.
+
+        @param context - Context
+        @param event - Dictionary gerrit event
+
+        """
+        start = time.time()
+        try:
+            self.func(context, event)
+            failed = False
+        except Exception:
+            logger.exception("Handler %s failed on %s event."
+                             % (self.name, event.get('type')))
+            failed = True
+        with self._lock:
+            self.seconds += time.time() - start
+            if failed:
+                self.failed += 1
+            else:
+                self.handled += 1
+
+    def metrics(self):
+        """
+        Returns the counters of the handler.
+
+        @returns - Dictionary
+
+        """
+        with self._lock:
+            return {
+                'received': self.received,
+                'skipped': self.skipped,
+                'handled': self.handled,
+                'failed': self.failed,
+                'seconds': self.seconds
+            }
+
+
+class Registry(object):
+    """
+    Set of handlers with compiled routes from stream and event type to
+    handlers.
+
+    """
+    def __init__(self):
+        """
+        Inits an empty registry.
+
+        """
+        self._handlers = []
+        self._routes = {}
+        self._pool = None
+
+    def __iter__(self):
+        return iter(self._handlers)
+
+    def register(self, handler):
+        """
+        Adds a handler and recompiles the routes.
+
+        @param handler - Handler
+
+        """
+        if any(h.name == handler.name for h in self._handlers):
+            raise ValueError("Handler %s already registered" % handler.name)
+        self._handlers.append(handler)
+        if self._pool is not None:
+            self._pool.add_queue(handler.name, handler.threads)
+        self.compile()
+
+    def compile(self):
+        """
+        Builds the routing dictionary,
+        {stream: {event type: tuple of handlers}}
+
+        """
+        routes = dict((stream, {}) for stream in STREAMS)
+        for handler in self._handlers:
+            for type_ in handler.types:
+                routes[handler.stream].setdefault(type_, []).append(handler)
+        self._routes = dict(
+            (stream, dict((t, tuple(h)) for t, h in types.iteritems()))
+            for stream, types in routes.iteritems()
+        )
+
+    def types(self, stream):
+        """
+        Returns the event types handled for a stream.
+
+        @param stream - String DOWNSTREAM or UPSTREAM
+        @returns - Sorted list of strings
+
+        """
+        return sorted(self._routes.get(stream, {}))
+
+    def start(self, pool):
+        """
+        Gives every handler a queue on the worker pool.
+
+        @param pool - thread.WorkerPool
+
+        """
+        self._pool = pool
+        for handler in self._handlers:
+            pool.add_queue(handler.name, handler.threads)
+
+    def dispatch(self, stream, event, context):
+        """
+        Queues an event on the handlers routed to for its stream and type.
+
+        @param stream - String DOWNSTREAM or UPSTREAM
+        @param event - Dictionary gerrit event
+        @param context - Context
+        @returns - Integer number of handlers the event was queued on
+
+        """
+        handlers = self._routes[stream].get(event.get('type'), ())
+        queued = 0
+        for handler in handlers:
+            if not handler.accepts(event):
+                continue
+            self._pool.add_named_task(handler.name, handler.run, context,
+                                      event)
+            queued += 1
+        return queued
+
+    def report(self):
+        """
+        Logs the counters and queue depth of every handler.
+
+        """
+        for handler in self._handlers:
+            metrics = handler.metrics()
+            metrics['queued'] = self._pool.queue_size(handler.name)
+            logger.debug(
+                "Handler %s: %s" % (handler.name, ", ".join(
+                    "%s %s" % (k, metrics[k]) for k in sorted(metrics)
+                ))
+            )
@@ -33,7 +33,7 @@ def get_logger(name='gerrit-python-tools'):
     return logging.getLogger(name)
 
 logging_conf_file = '/etc/gerrit-python-tools/logging.yaml'
-logging_conf = config.load_config(logging_conf_file, default=DEFAULT_CONFIG)
+logging_conf = config.read_config(logging_conf_file, default=DEFAULT_CONFIG)
 
 # Get log path/file from config
 logfile = logging_conf['file']
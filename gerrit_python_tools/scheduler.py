@@ -0,0 +1,274 @@
+"""
+Cost aware scheduling of project syncs. Keeps a history of how long each
+project takes to sync and how many bytes it transfers, and uses it to run
+cheap syncs first, limit how many expensive syncs run at once and keep a
+busy project from monopolizing the workers.
+
+"""
+import log
+import state
+import thread
+import threading
+import time
+
+logger = log.get_logger()
+
+
+class CostHistory(object):
+    """
+    Per project exponentially weighted averages of sync duration and bytes
+    transferred, kept in the state store under the cost namespace.
+
+    """
+    def __init__(self, store, weight=0.3, default=60.0):
+        """
+        Inits the history.
+
+        @param store - state.Store
+        @param weight - Float weight of the newest sample
+        @param default - Float seconds estimated for unknown projects
+
+        """
+        self.store = store
+        self.weight = weight
+        self.default = default
+        self._cache = dict(store.items('cost'))
+
+    def estimate(self, name):
+        """
+        Returns the expected sync duration of a project in seconds.
+
+        @param name - String project name
+        @returns Float
+
+        """
+        entry = self._cache.get(name)
+        if entry is None:
+            return self.default
+        return entry['duration']
+
+    def record(self, name, duration, nbytes=None):
+        """
+        Adds a sample to the history of a project.
+
+        @param name - String project name
+        @param duration - Float seconds the sync took
+        @param nbytes - Integer bytes transferred or None if unknown
+
+        """
+        entry = self._cache.get(name)
+        if entry is None:
+            entry = {'duration': duration, 'bytes': nbytes or 0}
+        else:
+            w = self.weight
+            entry = {
+                'duration': w * duration + (1 - w) * entry['duration'],
+                'bytes': w * (nbytes or 0) + (1 - w) * entry['bytes']
+                if nbytes is not None else entry['bytes']
+            }
+        entry['last'] = time.time()
+        self._cache[name] = entry
+        self.store.set('cost', name, entry)
+
+
+class Task(object):
+    """
+    A pending sync of a project.
+
+    """
+    def __init__(self, name, func, args, kwargs, not_before):
+        """
+        Inits the task.
+
+        @param name - String project name
+        @param func - Function to run. May return the number of bytes it
+            transferred.
+        @param args - List of args
+        @param kwargs - Dictionary of kwargs
+        @param not_before - Float time before which the task may not run
+
+        """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.not_before = not_before
+
+
+class Scheduler(object):
+    """
+    Runs project syncs on its own worker pool. Only hands a task to the pool
+    when a worker is free so ordering decisions are made as late as
+    possible. Among ready tasks, the one with the smallest expected duration
+    runs first, which minimizes average completion time. Heavy projects are
+    limited to heavy_limit concurrent syncs, each project runs at most once
+    at a time and no more often than its minimum interval. Tasks submitted
+    for a project that already has a pending task are merged into it.
+    Tasks may be submitted from any thread.
+
+    """
+    def __init__(self, numthreads, history, heavy=300, heavy_limit=1,
+                 min_interval=0, intervals=None):
+        """
+        Inits the scheduler and its worker pool.
+
+        @param numthreads - Integer number of syncs to run at once
+        @param history - CostHistory
+        @param heavy - Float expected seconds above which a sync is heavy
+        @param heavy_limit - Integer number of heavy syncs to run at once
+        @param min_interval - Float minimum seconds between the starts of
+            two syncs of the same project
+        @param intervals - Dictionary of per project minimum intervals
+
+        """
+        self.numthreads = numthreads
+        self.pool = thread.WorkerPool(numthreads)
+        self.history = history
+        self.heavy = float(heavy)
+        self.heavy_limit = int(heavy_limit)
+        self.min_interval = float(min_interval)
+        self.intervals = intervals or {}
+        self.pending = {}
+        self.running = {}
+        self.last_start = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        """
+        Returns the number of pending tasks.
+
+        @returns Integer
+
+        """
+        return len(self.pending)
+
+    def submit(self, name, func, args=None, kwargs=None, not_before=None,
+               merge=None):
+        """
+        Adds a sync of project name. Merges with a pending sync of the same
+        project, keeping the earliest start time and the newest task unless
+        merge decides otherwise.
+
+        @param name - String project name
+        @param func - Function to run
+        @param args - List of args
+        @param kwargs - Dictionary of kwargs
+        @param not_before - Float time before which the sync may not run
+        @param merge - Function called with the pending task and the new
+            task of the project. Returns the task to keep. None to keep
+            the new task.
+
+        """
+        not_before = not_before or time.time()
+        task = Task(name, func, args or [], kwargs or {}, not_before)
+        with self._lock:
+            pending = self.pending.get(name)
+            if pending:
+                if merge is not None:
+                    task = merge(pending, task)
+                task.not_before = min(not_before, pending.not_before)
+                logger.debug("Project %s: merged with pending sync." % name)
+            self.pending[name] = task
+
+    def is_heavy(self, name):
+        """
+        Returns whether or not a project is expected to be expensive.
+
+        @param name - String project name
+        @returns Boolean
+
+        """
+        return self.history.estimate(name) >= self.heavy
+
+    def ready(self, now):
+        """
+        Returns the pending task that should run next or None.
+
+        @param now - Float current time
+        @returns Task|None
+
+        """
+        with self._lock:
+            heavy_running = sum(1 for n in self.running if self.is_heavy(n))
+
+        candidates = []
+        for task in self.pending.values():
+            if task.not_before > now or task.name in self.running:
+                continue
+            interval = float(self.intervals.get(task.name, self.min_interval))
+            if now < self.last_start.get(task.name, 0) + interval:
+                continue
+            if self.is_heavy(task.name) and heavy_running >= self.heavy_limit:
+                continue
+            candidates.append(task)
+
+        if not candidates:
+            return None
+        return min(candidates, key=lambda t: self.history.estimate(t.name))
+
+    def dispatch(self):
+        """
+        Hands ready tasks to the pool while workers are free.
+
+        @returns Boolean - True if a task was dispatched
+
+        """
+        dispatched = False
+        now = time.time()
+        while len(self.running) < self.numthreads:
+            with self._lock:
+                task = self.ready(now)
+                if task is None:
+                    break
+                del self.pending[task.name]
+                self.running[task.name] = now
+            self.last_start[task.name] = now
+            self.pool.add_task(self.run, task)
+            dispatched = True
+        return dispatched
+
+    def run(self, task):
+        """
+        Runs a task on a worker and records its cost.
+
+        @param task - Task
+
+        """
+        start = time.time()
+        try:
+            nbytes = task.func(*task.args, **task.kwargs)
+            if not isinstance(nbytes, (int, long)):
+                nbytes = None
+            self.history.record(task.name, time.time() - start, nbytes)
+        finally:
+            with self._lock:
+                del self.running[task.name]
+
+
+def intervals(conf):
+    """
+    Returns the per project minimum sync intervals set in conf.
+
+    @param conf - config.Config
+    @returns Dictionary of seconds keyed by project name
+
+    """
+    return dict((p.name, p.min_interval) for p in conf.projects.itervalues()
+                if p.min_interval is not None)
+
+
+def from_config(conf):
+    """
+    Returns a Scheduler set up from the scheduler section of conf.
+
+    @param conf - config.Config
+    @returns Scheduler
+
+    """
+    section = conf['scheduler']
+    history = CostHistory(state.get_store(conf['state']['file']))
+    return Scheduler(int(section['numthreads']), history,
+                     heavy=section['heavy'],
+                     heavy_limit=section['heavy-limit'],
+                     min_interval=section['min-interval'],
+                     intervals=intervals(conf))
@@ -1,89 +1,189 @@
+import atexit
+import cluster
 import config
-import gerrit
+import handlers
 import log
+import scheduler
 import signal
+import state
 import time
 import thread
 import sync
 import upstream
+import workspace
 
 
 logger = log.get_logger()
 
 
-def pull_downstream(conf, stream, pool, schedule, yaml_file):
+def handle_comment_added(context, event):
     """
-    Pulls an event from the queue on downstream.
-    Filters and assigns tasks to handle this event.
+    Holds comment-added events that could lead to a send upstream for a
+    batched send.
+
+    @param context - handlers.Context
+    @param event - Dictionary comment-added event
+
+    """
+    if context.conf['daemon']['upstream'] and context.admission.admit(event):
+        context.batcher.add(event)
+
+
+def handle_ref_updated(context, event):
+    """
+    Schedules a sync of the ref that was updated upstream.
+
+    @param context - handlers.Context
+    @param event - Dictionary ref-updated event
+
+    """
+    if context.conf['daemon']['sync']:
+        ref_update = event['refUpdate']
+        name = ref_update['project']
+        update = (ref_update.get('refName'), ref_update.get('oldRev'),
+                  ref_update.get('newRev'))
+        t = time.time() + int(context.conf['daemon']['delay'])
+        args = [context.yaml_file, name, [update]]
+        context.schedule.submit(name, sync.sync_refs, args, not_before=t,
+                                merge=sync.merge_syncs)
+
+
+def handle_acl_updated(context, event):
+    """
+    Schedules reapplying the ACL of a project whose refs/meta/config was
+    changed on downstream by someone other than this tool. Going through
+    the scheduler keeps it from running alongside a sync of the project.
+
+    @param context - handlers.Context
+    @param event - Dictionary ref-updated event
+
+    """
+    if context.conf['daemon']['acl']:
+        ref_update = event['refUpdate']
+        name = ref_update['project']
+        args = [context.yaml_file, name, ref_update.get('newRev')]
+        context.schedule.submit(name, sync.sync_acl, args,
+                                merge=sync.merge_syncs)
+
+
+def is_meta_config(project, branch):
+    """
+    Predicate of handlers of refs/meta/config updates.
+
+    @param project - String project name
+    @param branch - String ref name
+    @returns - Boolean
+
+    """
+    return branch == 'refs/meta/config'
+
+
+def default_registry():
+    """
+    Returns the registry of the handlers the service runs.
+
+    @returns - handlers.Registry
+
+    """
+    registry = handlers.Registry()
+    registry.register(handlers.Handler(
+        'send-upstream', ['comment-added'], handlers.DOWNSTREAM,
+        handle_comment_added
+    ))
+    registry.register(handlers.Handler(
+        'sync-project', ['ref-updated'], handlers.UPSTREAM,
+        handle_ref_updated
+    ))
+    registry.register(handlers.Handler(
+        'acl-drift', ['ref-updated'], handlers.DOWNSTREAM,
+        handle_acl_updated, predicate=is_meta_config
+    ))
+    return registry
+
+
+def pull(stream, name, registry, context):
+    """
+    Pulls an event from the queue of a remote's stream and dispatches it
+    to the handlers of the roles the remote plays for the event's project.
     Does nothing if there is no event.
 
-    @param conf - Dictionary
     @param stream - gerrit.SSHStream object
-    @param pool - thread.WorkerPool
-    @param schedule - List of (time, tasks) tuples. Use to schedule
-        events later.
-    @param yaml_file - Location of configuration file
+    @param name - String name of the remote
+    @param registry - handlers.Registry
+    @param context - handlers.Context
     @return Boolean - True if event was process, False Otherwise
 
     """
     event = stream.get_event()
-    # Look for comment added type events
-    if event and event.get('type') == 'comment-added':
-        if conf['daemon']['upstream']:
-            args = [yaml_file, event]
-            kwargs = {}
-            pool.add_task(upstream.send_upstream, *args, **kwargs)
+    if event:
+        project, _ = handlers.event_target(event)
+        if not owns(context.cluster, project or ''):
+            return True
+        for role in context.conf.roles(name, project):
+            registry.dispatch(role, event, context)
     return event is not None
 
 
-def pull_upstream(_config, stream, pool, schedule, yaml_file):
+def owns(members, key):
     """
-    Pulls an event from the queue on upstream.
-    Filters and assigns tasks to handle this event.
-    Does nothing if there is no event.
+    Returns whether or not this daemon does the work of key. A daemon
+    running alone does all the work.
 
-    @param conf - Dictionary
-    @param stream - gerrit.SSHStream object
-    @param pool - thread.WorkerPool
-    @param schedule - List of (time, tasks) tuples. Use to schedule
-        events later.
-    @param yaml_file - Location of configuration file
-    @return Boolean - True if event was process, False Otherwise
+    @param members - cluster.Cluster or None
+    @param key - String project name or cluster.LEADER
+    @return Boolean
 
     """
-    delay = int(_config['daemon']['delay'])
-    event = stream.get_event()
-    if event and event.get('type') == 'ref-updated':
-        if _config['daemon']['sync']:
-            name = event['refUpdate']['project']
-            t = time.time() + delay
-            args = []
-            kwargs = {
-                'yaml_file': yaml_file,
-                'users': False,
-                'groups': False,
-                'project': name
-            }
-            schedule.append((t, sync.sync, args, kwargs))
+    return members is None or members.owns(key)
 
-    return event is not None
+
+def update_streams(streams, conf, registry):
+    """
+    Starts a stream for every remote in use and stops the streams of
+    remotes that are no longer used or whose connection info changed.
+    Each stream subscribes to the event types handled for the roles its
+    remote plays.
+
+    @param streams - Dictionary of remote name to (key, gerrit.SSHStream),
+        updated in place
+    @param conf - config.Config
+    @param registry - handlers.Registry
+
+    """
+    for name, roles in conf.remote_roles.iteritems():
+        remote = conf.remotes[name]
+        types = sorted(set(t for role in roles for t in registry.types(role)))
+        key = (remote._key(), tuple(types))
+        if name in streams and streams[name][0] == key:
+            continue
+        if name in streams:
+            logger.info("Remote %s: Restarting event stream." % name)
+            streams[name][1].stop()
+        stream = remote.SSHStream(types=types)
+        stream.start()
+        streams[name] = (key, stream)
+
+    for name in set(streams) - set(conf.remote_roles):
+        logger.info("Remote %s: No longer used, stopping event stream."
+                    % name)
+        streams.pop(name)[1].stop()
 
 
 def service(yaml_file):
     """
-    Initializes a downstream event listener, an upstream event listener,
-    and a threadpool to handle events from both. Also sets up a schedule
-    if things need to be delayed.
+    Initializes an event listener per remote in use, and a threadpool to
+    handle events from all of them. Also sets up a schedule if things need
+    to be delayed.
 
     Runs in infinite loop until killed.
-    Each loop iteration consists of checking the schedule, checking
-    downstream, then checking upstream. Sleep if no action taken.
+    Each loop iteration consists of checking the schedule, then checking
+    each remote. Sleep if no action taken.
 
     @param yaml_file - String location to configuration
 
     """
     # Get configuraion
-    _config = config.load_config(yaml_file)
+    _config = config.get_config(yaml_file)
 
     numthreads = int(_config['daemon']['numthreads'])
     sleep = int(_config['daemon']['sleep'])
@@ -92,40 +192,118 @@ def service(yaml_file):
     signal.signal(signal.SIGINT, thread.stop_threads)
     signal.signal(signal.SIGTERM, thread.stop_threads)
 
-    schedule = list()
+    # Reload the configuration on SIGHUP
+    signal.signal(signal.SIGHUP, config.reload_configs)
+
+    # Share ssh connections between git commands
+    sync.configure_ssh(_config)
+
     pool = thread.WorkerPool(numthreads)
+    schedule = scheduler.from_config(_config)
+    admission = upstream.AdmissionFilter(_config)
+    batcher = upstream.Batcher(_config['daemon']['batch-window'])
+    store = state.get_store(_config['state']['file'])
+    # Share the work with other daemons using the same state file
+    members = cluster.from_config(_config, store)
+    next_heartbeat = time.time()
+    if members is not None:
+        members.heartbeat()
+        atexit.register(members.leave)
+        next_heartbeat += float(_config['cluster']['heartbeat'])
+
+    reconciler = upstream.StatusReconciler(store)
+    next_reconcile = time.time()
+    trigger_sweep = upstream.TriggerSweep(store)
+    next_sweep = time.time()
+
+    # Have a scratch repository ready for every project sent upstream
+    if _config['daemon']['upstream']:
+        workspace.get_manager(_config).prewarm(
+            sorted(_config.upstream_projects)
+        )
 
-    downstream_remote = gerrit.Remote(_config['gerrit'])
-    downstream = downstream_remote.SSHStream()
-    downstream.start()
+    # Route stream events to their handlers
+    registry = default_registry()
+    registry.start(pool)
+    context = handlers.Context(conf=_config, yaml_file=yaml_file,
+                               admission=admission, batcher=batcher,
+                               schedule=schedule, cluster=members)
 
-    upstream_remote = gerrit.Remote(_config['upstream'])
-    upstream = upstream_remote.SSHStream()
-    upstream.start()
+    # One event stream per remote in use
+    streams = {}
+    update_streams(streams, _config, registry)
 
     while True:
-        downstream_active = False
-        upstream_active = False
+        # Renew the membership and pick up members that joined or died
+        if members is not None and time.time() >= next_heartbeat:
+            try:
+                members.heartbeat()
+                next_heartbeat = time.time() + float(
+                    _config['cluster']['heartbeat'])
+            except Exception:
+                # The shared state file may be locked, retry next pass
+                logger.exception("Cluster heartbeat failed.")
+        leader = owns(members, cluster.LEADER)
 
-        # Check schedule and add events to event pool
-        if len(schedule) > 0 and time.time() > schedule[0][0]:
-            t, func, args, kwargs = schedule.pop(0)
-            pool.add_task(func, *args, **kwargs)
+        # Pick up configuration changes. Running tasks keep their snapshot.
+        try:
+            latest = config.get_config(yaml_file)
+        except Exception:
+            logger.exception("Unable to reload configuration %s."
+                             % yaml_file)
+            latest = _config
+        if latest is not _config:
+            logger.info("Configuration %s reloaded." % yaml_file)
+            changes = config.diff(_config, latest)
+            _config = latest
+            admission = upstream.AdmissionFilter(_config)
+            context.conf = _config
+            context.admission = admission
+            batcher.window = float(_config['daemon']['batch-window'])
+            schedule.intervals = scheduler.intervals(_config)
+            update_streams(streams, _config, registry)
+
+            # Only sync what changed in the configuration
+            if leader and _config['daemon']['sync'] and (
+                    changes.full or changes.groups or changes.users or
+                    changes.projects):
+                pool.add_task(sync.resync, yaml_file=yaml_file,
+                              changes=changes, schedule=schedule)
+
+        # Mirror the status of changes sent upstream back downstream
+        if (leader and _config['daemon']['upstream'] and
+                _config['reconcile']['enabled'] and
+                time.time() >= next_reconcile):
+            pool.add_task(upstream.reconcile, yaml_file, reconciler)
+            next_reconcile = time.time() + int(
+                _config['reconcile']['interval'])
+
+        # Pick up changes whose trigger was missed
+        if (leader and _config['daemon']['upstream'] and
+                _config['sweep']['enabled'] and
+                time.time() >= next_sweep):
+            pool.add_task(upstream.sweep, yaml_file, trigger_sweep, batcher)
+            next_sweep = time.time() + int(_config['sweep']['interval'])
+
+        # Send held upstream-ready changes together
+        for events in batcher.flush():
+            pool.add_task(upstream.send_batch, yaml_file, events)
+
+        # Hand ready project syncs to the sync workers
+        if schedule.dispatch():
             continue
 
         # Check for new events
-        downstream_active = pull_downstream(_config, downstream,
-                                            pool, schedule, yaml_file)
-        upstream_active = pull_upstream(_config, upstream,
-                                        pool, schedule, yaml_file)
-
-        if downstream_active:
-            logger.debug("Downstream is active")
-        if upstream_active:
-            logger.debug("Upstream is active")
+        active = [name for name, (_, stream) in sorted(streams.iteritems())
+                  if pull(stream, name, registry, context)]
+
+        if active:
+            logger.debug("Active remotes: %s" % ", ".join(active))
         logger.debug("Schedule len: %s" % len(schedule))
+        logger.debug("Held upstream events: %s" % len(batcher))
+        registry.report()
 
         # Sleep if no events recieved.
-        if not downstream_active and not upstream_active:
+        if not active:
             time.sleep(sleep)
             continue
@@ -0,0 +1,447 @@
+"""
+Small persistent key value store backed by sqlite. Values are stored as
+json. Keys are grouped into namespaces so different features can share
+one state file.
+
+"""
+import json
+import log
+import os
+import random
+import sqlite3
+import threading
+import time
+
+logger = log.get_logger()
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class Store(object):
+    """
+    Namespaced key value store kept in a sqlite file. Each thread gets its
+    own sqlite connection.
+
+    """
+    def __init__(self, filename):
+        """
+        Inits the store, creating the file and table if needed.
+
+        @param filename - String location of the sqlite file
+
+        """
+        self.filename = os.path.abspath(os.path.expanduser(filename))
+        self._local = threading.local()
+
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with self.connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                         ' namespace TEXT NOT NULL,'
+                         ' key TEXT NOT NULL,'
+                         ' value TEXT NOT NULL,'
+                         ' PRIMARY KEY (namespace, key))')
+
+    def connection(self):
+        """
+        Returns the sqlite connection of the current thread.
+
+        @returns sqlite3.Connection
+
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace, key, default=None):
+        """
+        Returns the value stored under namespace and key.
+
+        @param namespace - String namespace
+        @param key - String key
+        @param default - Value returned if nothing is stored
+        @returns - JSON loaded value or default
+
+        """
+        row = self.connection().execute(
+            'SELECT value FROM state WHERE namespace = ? AND key = ?',
+            (namespace, key)
+        ).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value):
+        """
+        Stores value under namespace and key, replacing any existing value.
+
+        @param namespace - String namespace
+        @param key - String key
+        @param value - JSON serializable value
+
+        """
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                         (namespace, key, json.dumps(value)))
+
+    def delete(self, namespace, key):
+        """
+        Removes the value stored under namespace and key.
+
+        @param namespace - String namespace
+        @param key - String key
+
+        """
+        with self.connection() as conn:
+            conn.execute('DELETE FROM state WHERE namespace = ? AND key = ?',
+                         (namespace, key))
+
+    def update(self, namespace, key, func):
+        """
+        Atomically replaces the value stored under namespace and key with
+        func(value). Other threads and processes using the same file wait
+        until the update is done.
+
+        @param namespace - String namespace
+        @param key - String key
+        @param func - Function taking the stored value or None and
+            returning the new value or None to leave it unchanged
+        @returns - The new value or None if unchanged
+
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT value FROM state WHERE namespace = ? AND key = ?',
+                (namespace, key)
+            ).fetchone()
+            value = func(json.loads(row[0]) if row else None)
+            if value is not None:
+                conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                             (namespace, key, json.dumps(value)))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        return value
+
+    def items(self, namespace):
+        """
+        Returns all key value pairs in a namespace.
+
+        @param namespace - String namespace
+        @returns - List of (key, value) tuples
+
+        """
+        rows = self.connection().execute(
+            'SELECT key, value FROM state WHERE namespace = ?', (namespace,)
+        )
+        return [(key, json.loads(value)) for key, value in rows]
+
+
+def get_store(filename):
+    """
+    Returns the process wide Store for filename.
+
+    @param filename - String location of the sqlite file
+    @returns Store
+
+    """
+    with _stores_lock:
+        store = _stores.get(filename)
+        if store is None:
+            store = Store(filename)
+            _stores[filename] = store
+    return store
+
+
+class Memo(object):
+    """
+    Remembers the fingerprint of an entity's configuration and of the
+    remote state observed when the entity last converged. Entities whose
+    fingerprints still match can be skipped. A fraction of converged
+    entities is verified anyway to catch drift the fingerprints miss.
+
+    """
+    def __init__(self, store, full=False, verify_rate=0.0):
+        """
+        Inits the memo.
+
+        @param store - Store
+        @param full - Boolean never report entities as converged
+        @param verify_rate - Float fraction of converged entities to verify
+
+        """
+        self.store = store
+        self.full = full
+        self.verify_rate = float(verify_rate)
+
+    def entry(self, kind, name):
+        """
+        Returns the recorded entry for an entity or None. Returns None when
+        running full or when the entity was picked for verification.
+
+        @param kind - String kind of entity(group, user, project)
+        @param name - String name of the entity
+        @returns Dictionary|None
+
+        """
+        if self.full or random.random() < self.verify_rate:
+            return None
+        return self.store.get('memo:%s' % kind, name)
+
+    def known(self, kind, name):
+        """
+        Returns whether or not the entity is recorded as converged. Unlike
+        entry, never picks the entity for verification.
+
+        @param kind - String kind of entity
+        @param name - String name of the entity
+        @returns Boolean
+
+        """
+        return self.store.get('memo:%s' % kind, name) is not None
+
+    def converged(self, kind, name, config, remote=None):
+        """
+        Returns whether or not the entity converged with the same
+        configuration and remote state.
+
+        @param kind - String kind of entity
+        @param name - String name of the entity
+        @param config - String configuration fingerprint
+        @param remote - String remote state fingerprint
+        @returns Boolean
+
+        """
+        entry = self.entry(kind, name)
+        return (entry is not None and entry['config'] == config and
+                entry['remote'] == remote)
+
+    def forget(self, kind, name):
+        """
+        Removes the record of an entity. Done before working on an entity
+        so a failed attempt is not mistaken for convergence.
+
+        @param kind - String kind of entity
+        @param name - String name of the entity
+
+        """
+        self.store.delete('memo:%s' % kind, name)
+
+    def record(self, kind, name, config, remote=None):
+        """
+        Records that an entity converged.
+
+        @param kind - String kind of entity
+        @param name - String name of the entity
+        @param config - String configuration fingerprint
+        @param remote - String remote state fingerprint
+
+        """
+        self.store.set('memo:%s' % kind, name, {
+            'config': config,
+            'remote': remote,
+            'time': time.time()
+        })
+
+    def refresh(self, kind, name, config, remote):
+        """
+        Records the new remote state of an entity changed without a full
+        sync. Entities not recorded with the same configuration are left
+        for a full sync.
+
+        @param kind - String kind of entity
+        @param name - String name of the entity
+        @param config - String configuration fingerprint
+        @param remote - String remote state fingerprint
+        @returns Boolean - True if the entity was recorded
+
+        """
+        entry = self.store.get('memo:%s' % kind, name)
+        if entry is None or entry['config'] != config:
+            return False
+        self.record(kind, name, config, remote)
+        return True
+
+
+class Ledger(object):
+    """
+    Records sends of patch sets upstream, keyed by change number, patch set
+    number and revision. A send is claimed before it starts and recorded
+    with its upstream url when it is done, so duplicate triggers can be
+    answered without asking either gerrit. A claim older than timeout is
+    considered abandoned by a process that died. Sends that failed are
+    recorded with the number of attempts and when they may be retried.
+
+    """
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    def __init__(self, store, timeout=3600):
+        """
+        Inits the ledger.
+
+        @param store - Store
+        @param timeout - Float seconds after which a claim expires
+
+        """
+        self.store = store
+        self.timeout = float(timeout)
+
+    @staticmethod
+    def key(change, patchset, revision):
+        """
+        Returns the ledger key of a patch set.
+
+        @param change - Integer change number
+        @param patchset - Integer patch set number
+        @param revision - String commit sha of the patch set
+        @returns String
+
+        """
+        return '%s,%s,%s' % (change, patchset, revision)
+
+    def _live(self, entry):
+        """
+        Returns whether or not an entry blocks another send.
+
+        @param entry - Dictionary|None
+        @returns Boolean
+
+        """
+        if entry is None or entry['status'] == self.FAILED:
+            return False
+        if entry['status'] == self.SENT:
+            return True
+        return time.time() - entry['time'] < self.timeout
+
+    def lookup(self, key):
+        """
+        Returns the entry of a patch set that is sent or being sent or None.
+
+        @param key - String ledger key
+        @returns Dictionary|None
+
+        """
+        entry = self.store.get('ledger', key)
+        return entry if self._live(entry) else None
+
+    def claim(self, key):
+        """
+        Claims the send of a patch set. Fails if it was sent or another
+        send is in progress.
+
+        @param key - String ledger key
+        @returns Boolean - True if claimed
+
+        """
+        def _claim(entry):
+            if self._live(entry):
+                return None
+            return {'status': self.SENDING, 'time': time.time(),
+                    'pid': os.getpid(),
+                    'attempts': (entry or {}).get('attempts', 0)}
+        return self.store.update('ledger', key, _claim) is not None
+
+    def finish(self, key, url, info=None):
+        """
+        Records that a patch set was sent. Sends with details are also
+        kept in the sent namespace, so they can be listed without reading
+        the whole ledger.
+
+        @param key - String ledger key
+        @param url - String url of the change upstream
+        @param info - Dictionary of details to keep with the entry, like
+            the Change-Id, project and branch
+
+        """
+        entry = dict(info or {})
+        entry.update({'status': self.SENT, 'time': time.time(), 'url': url})
+        self.store.set('ledger', key, entry)
+        if info:
+            self.store.set('sent', key, entry)
+
+    def sent(self):
+        """
+        Returns the entries of sent patch sets that have details.
+
+        @returns - List of (key, entry) tuples
+
+        """
+        return self.store.items('sent')
+
+    def index(self):
+        """
+        Adds the sent entries with details recorded before the sent
+        namespace existed to it. Reads the whole ledger.
+
+        @returns - Integer number of entries added
+
+        """
+        added = 0
+        for key, entry in self.store.items('ledger'):
+            if entry['status'] != self.SENT or 'change_id' not in entry:
+                continue
+            if self.store.get('sent', key) is None:
+                self.store.set('sent', key, entry)
+                added += 1
+        return added
+
+    def forget(self, keys):
+        """
+        Removes the entries of patch sets that no longer need to be kept,
+        like those of changes merged upstream.
+
+        @param keys - List of string ledger keys
+
+        """
+        for key in keys:
+            self.store.delete('ledger', key)
+            self.store.delete('sent', key)
+
+    def fail(self, key, backoff=900):
+        """
+        Records that the send of a patch set failed. The wait before the
+        send may be retried doubles with each failed attempt.
+
+        @param key - String ledger key
+        @param backoff - Float seconds to wait after the first failure
+
+        """
+        def _fail(entry):
+            attempts = (entry or {}).get('attempts', 0) + 1
+            now = time.time()
+            return {'status': self.FAILED, 'time': now,
+                    'attempts': attempts,
+                    'retry': now + float(backoff) * 2 ** (attempts - 1)}
+        self.store.update('ledger', key, _fail)
+
+    def failed(self, key):
+        """
+        Returns the entry of a patch set whose last send failed or None.
+
+        @param key - String ledger key
+        @returns Dictionary|None
+
+        """
+        entry = self.store.get('ledger', key)
+        if entry is None or entry['status'] != self.FAILED:
+            return None
+        return entry
+
+    def abandon(self, key):
+        """
+        Drops the claim of a send that failed so it can be retried.
+
+        @param key - String ledger key
+
+        """
+        self.store.delete('ledger', key)
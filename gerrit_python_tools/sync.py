@@ -1,111 +1,385 @@
 import config
+import fnmatch
 import gerrit
+import git
+import hashlib
+import heapq
 import log
 import logging
+import signal
+import state
+import thread
+import threading
 import time
 import traceback
+import utils
 
 
 logger = log.get_logger()
 
 
-def sync_groups(_config):
+def get_memo(_config, full=False):
     """
-    Ensures groups listed described by _config are present. Will create them
-    if they DO NOT exist but will leave them alone if they DO exist.
+    Returns a state.Memo using the state file named by _config.
 
-    @param _config - Dictionary
+    @param _config - config.Config
+    @param full - Boolean ignore previously converged entities
+    @returns state.Memo
 
     """
-    remote = gerrit.Remote(_config['gerrit'])
-    for group_data in _config.get('groups', []):
-        try:
-            group = gerrit.Group(group_data)
-            group.present(remote)
-            print ""
-        except:
-            logger.exception("Unable to sync group")
-            traceback.print_exc()
+    store = state.get_store(_config['state']['file'])
+    return state.Memo(store, full=full,
+                      verify_rate=_config['sync']['verify-rate'])
 
 
-def sync_users(_config):
+def configure_ssh(_config):
     """
-    Ensures users desribed by _config are present. Will create them if they
-    DO NOT exist but will leave them alone if they DO exist.
+    Sets up ssh connection sharing of git commands from the ssh section
+    of the configuration.
 
-    @param _config - Dictionary
+    @param _config - config.Config
 
     """
-    remote = gerrit.Remote(_config['gerrit'])
-    for user_data in _config.get('users', []):
-        try:
-            user = gerrit.User(user_data)
-            user.present(remote)
-            print ""
-        except:
-            logger.exception("Unable to sync user")
-            traceback.print_exc()
+    git.configure_ssh(multiplex=_config['ssh']['multiplex'],
+                      persist=_config['ssh']['persist'])
 
 
-def sync_projects(_config, specific=None):
+def memo_name(remote_name, name):
     """
-    Syncs projects described in _config. Projects that are to be synced
-    have a source repo. Syncing is the process of pushing those changes
-    to downstream. Optionally, a specific project can be named and only
-    that project will be synced.
+    Returns the name an entity of a remote is memoized under. Entities of
+    the default downstream keep their plain names.
 
-    @param _config - Dictionary
-    @param specific - String name of a specific project.
+    @param remote_name - String remote name
+    @param name - String entity name
+    @returns String
 
     """
-    remote = gerrit.Remote(_config['gerrit'])
+    if remote_name == config.DEFAULT_DOWNSTREAM:
+        return name
+    return '%s:%s' % (remote_name, name)
 
-    # Convert project dictionaries to Project objects
-    projects = [gerrit.Project(p) for p in _config.get('projects', [])]
 
-    # If a specific project is provided, filter out other projects
-    if specific:
-        projects = [p for p in projects if p.name == specific]
-        if not projects:
-            msg = "Project %s: Not in configuration" % specific
+def sync_groups(_config, names=None, memo=None):
+    """
+    Ensures groups listed described by _config are present on every
+    downstream. Will create them if they DO NOT exist but will leave them
+    alone if they DO exist.
+    Optionally, only the named groups are ensured. Groups the memo reports
+    as converged, with the same configuration and the same record on
+    gerrit, are skipped. Groups created by this run are recorded by the
+    next one.
+
+    @param _config - config.Config
+    @param names - List of group names or None for all groups
+    @param memo - state.Memo or None
+
+    """
+    for remote_name in _config.downstream_names:
+        remote = _config.remotes[remote_name]
+        records = None
+        if memo:
+            try:
+                records = gerrit.group_records(remote)
+            except Exception:
+                logger.exception("Unable to list groups on %s"
+                                 % remote_name)
+        for group_data in _config.get('groups', []):
+            if names is not None and group_data.get('name') not in names:
+                continue
+            try:
+                group = gerrit.Group(group_data)
+                key = memo_name(remote_name, group.name)
+                fingerprint = utils.fingerprint(group_data)
+                record = (records or {}).get(group.name)
+                state = utils.fingerprint(record) if record else None
+                if state and memo.converged('group', key, fingerprint,
+                                            state):
+                    logger.debug("Group %s: Unchanged." % key)
+                    continue
+                if memo:
+                    memo.forget('group', key)
+                if group.present(remote) and state:
+                    memo.record('group', key, fingerprint, state)
+                print ""
+            except:
+                logger.exception("Unable to sync group")
+                traceback.print_exc()
+
+
+def sync_users(_config, names=None, memo=None):
+    """
+    Ensures users desribed by _config are present on every downstream. Will
+    create them if they DO NOT exist but will leave them alone if they DO
+    exist.
+    Optionally, only the named users are ensured. Users the memo reports
+    as converged, with the same configuration and the same membership
+    records in their groups on gerrit, are skipped. Users without groups
+    have no record to compare, so changes to them on gerrit are only
+    caught by the memo's verification sample. Users created by this run
+    are recorded by the next one.
+
+    @param _config - config.Config
+    @param names - List of usernames or None for all users
+    @param memo - state.Memo or None
+
+    """
+    for remote_name in _config.downstream_names:
+        remote = _config.remotes[remote_name]
+        # Members of each group, listed once per remote
+        members = {}
+        for user_data in _config.get('users', []):
+            if names is not None and user_data.get('username') not in names:
+                continue
+            try:
+                user = gerrit.User(user_data)
+                key = memo_name(remote_name, user.username)
+                fingerprint = utils.fingerprint(user_data)
+                state = None
+                if memo:
+                    for group in user.groups:
+                        if group not in members:
+                            members[group] = gerrit.member_records(remote,
+                                                                   group)
+                    rows = [members[g].get(user.username)
+                            for g in user.groups]
+                    if all(rows):
+                        state = utils.fingerprint(rows)
+                if state and memo.converged('user', key, fingerprint,
+                                            state):
+                    logger.debug("User %s: Unchanged." % key)
+                    continue
+                if memo:
+                    memo.forget('user', key)
+                if user.present(remote) and state:
+                    memo.record('user', key, fingerprint, state)
+                print ""
+            except:
+                logger.exception("Unable to sync user")
+                traceback.print_exc()
+
+
+def ensure_project(p, remote, _config, memo=None):
+    """
+    Ensures a single project. Skips the project if the memo reports that
+    neither its configuration nor the refs on the source and on gerrit
+    changed since it last converged.
+
+    @param p - gerrit.Project
+    @param remote - gerrit.Remote object
+    @param _config - config.Config
+    @param memo - state.Memo or None
+    @returns Integer bytes cloned from the source or None if not synced
+
+    """
+    if not memo:
+        return p.ensure(remote, _config)
+
+    fingerprint = p.fingerprint()
+    entry = memo.entry('project', p.name)
+    if entry and entry['config'] == fingerprint:
+        if entry['remote'] == p.remote_state(remote):
+            msg = "Project %s: Unchanged." % p.name
+            logger.info(msg)
+            print msg
+            return None
+
+    memo.forget('project', p.name)
+    nbytes = p.ensure(remote, _config)
+    memo.record('project', p.name, fingerprint, p.remote_state(remote))
+    return nbytes
+
+
+class SyncReport(object):
+    """
+    Collects the outcome of project syncs that may run on several threads.
+    Reports progress as each project finishes and summarizes at the end.
+
+    """
+    def __init__(self, total):
+        """
+        Inits the report.
+
+        @param total - Integer number of projects to be synced
+
+        """
+        self.total = total
+        self.results = []
+        self._lock = threading.Lock()
+
+    def add(self, name, duration, error=None):
+        """
+        Records and reports the outcome of a project sync.
+
+        @param name - String project name
+        @param duration - Float seconds the sync took
+        @param error - Exception or None if the sync succeeded
+
+        """
+        with self._lock:
+            self.results.append((name, duration, error))
+            status = "failed" if error else "done"
+            msg = "Project %s: %s in %.1f seconds (%s/%s)" % (
+                name, status, duration, len(self.results), self.total
+            )
+            logger.info(msg)
+            print msg
+
+    def summary(self):
+        """
+        Logs and prints the slowest projects and any failures.
+
+        """
+        failures = [r for r in self.results if r[2]]
+        slowest = sorted(self.results, key=lambda r: r[1], reverse=True)
+        total = sum(r[1] for r in self.results)
+
+        lines = ["Synced %s project(s) in %.1f project seconds, %s failed."
+                 % (len(self.results), total, len(failures))]
+        for name, duration, _ in slowest[:10]:
+            lines.append("  %-40s %.1f seconds" % (name, duration))
+        for name, _, error in failures:
+            lines.append("  FAILED %s: %s" % (name, error))
+
+        msg = "\n".join(lines)
+        logger.info(msg)
+        print msg
+
+
+def select_projects(_config, specific):
+    """
+    Returns the configured projects named by specific. Names may be glob
+    patterns. Logs names and patterns that match nothing.
+
+    @param _config - config.Config
+    @param specific - String name or list of names or patterns
+    @returns List of gerrit.Project
+
+    """
+    projects = []
+    seen = set()
+    for pattern in git.listify(specific):
+        if any(c in pattern for c in '*?['):
+            names = fnmatch.filter(_config.projects.keys(), pattern)
+        else:
+            names = [pattern] if _config.project(pattern) else []
+
+        if not names:
+            msg = "Project %s: Not in configuration" % pattern
             logger.error(msg)
             print msg
 
-    for p in projects:
-        try:
-            p.ensure(remote, _config)
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                projects.append(_config.project(name))
+    return projects
+
+
+def sync_project(p, remote, _config, memo, report):
+    """
+    Syncs one project and adds the outcome to report.
+
+    @param p - gerrit.Project
+    @param remote - gerrit.Remote object
+    @param _config - config.Config
+    @param memo - state.Memo or None
+    @param report - SyncReport
+
+    """
+    start = time.time()
+    error = None
+    try:
+        ensure_project(p, remote, _config, memo=memo)
+    except Exception as e:
+        logger.exception("Unable to sync project")
+        traceback.print_exc()
+        error = e
+    report.add(p.name, time.time() - start, error)
+
+
+def sync_projects(_config, specific=None, memo=None, jobs=1):
+    """
+    Syncs projects described in _config. Projects that are to be synced
+    have a source repo. Syncing is the process of pushing those changes
+    to downstream. Optionally, specific projects can be named and only
+    those projects will be synced. Projects are synced on a pool of jobs
+    threads when jobs is greater than 1.
+
+    @param _config - config.Config
+    @param specific - String name or list of names or glob patterns of
+        specific projects.
+    @param memo - state.Memo or None
+    @param jobs - Integer number of projects to sync at once
+
+    """
+    # Project objects are compiled with the configuration
+    projects = _config.projects.values()
+
+    # If specific projects are provided, filter out other projects
+    if specific:
+        projects = select_projects(_config, specific)
+
+    report = SyncReport(len(projects))
+    jobs = min(int(jobs), len(projects))
+
+    if jobs > 1:
+        pool = thread.WorkerPool(jobs)
+        for p in projects:
+            pool.add_task(sync_project, p, _config.downstream(p.name),
+                          _config, memo, report)
+        pool.wait()
+        pool.stop()
+    else:
+        for p in projects:
+            sync_project(p, _config.downstream(p.name), _config, memo,
+                         report)
             print ""
-        except:
-            logger.exception("Unable to sync project")
-            traceback.print_exc()
 
+    report.summary()
 
-def sync(yaml_file=None, groups=True, users=True, projects=True, project=None):
+
+def sync(yaml_file=None, groups=True, users=True, projects=True, project=None,
+         full=False, verify_rate=None, jobs=None):
     """
     Main sync entry point. Orchestrates the syncing of users, groups, and
-    projects as described by a yaml file.
+    projects as described by a yaml file. Entities that converged with
+    the same configuration and remote state are skipped unless full is set.
 
     @param yaml_file - String location of a yaml file.
     @param groups - Boolean Groups will be synced if true.
     @param users - Boolean Users will be synced if true.
     @param projects - Boolean Projects will be synced if true.
-    @param project - String specific project to sync.
+    @param project - String or list of specific projects or glob patterns
+        to sync.
+    @param full - Boolean Sync every entity if true.
+    @param verify_rate - Float fraction of converged entities to sync
+        anyway. Uses the configured rate if None.
+    @param jobs - Integer number of projects to sync at once. Uses the
+        configured number if None.
 
     """
     try:
-        _config = config.load_config(yaml_file)
+        _config = config.get_config(yaml_file)
+        configure_ssh(_config)
 
         start = time.time()
         logger.info("gerrit-sync starting...")
 
+        memo = get_memo(_config, full=full)
+        if verify_rate is not None:
+            memo.verify_rate = verify_rate
+
         if groups:
-            sync_groups(_config)
+            sync_groups(_config, memo=memo)
 
         if users:
-            sync_users(_config)
+            sync_users(_config, memo=memo)
+
+        if jobs is None:
+            jobs = _config['sync']['jobs']
 
         if projects:
-            sync_projects(_config, specific=project)
+            sync_projects(_config, specific=project, memo=memo, jobs=jobs)
 
         duration = time.time() - start
         msg = "gerrit-sync run finished in %s seconds." % duration
@@ -114,3 +388,420 @@ def sync(yaml_file=None, groups=True, users=True, projects=True, project=None):
     except Exception as e:
         logging.exception("Error occurred:")
         raise e
+
+
+def sync_one(yaml_file, name):
+    """
+    Syncs a single project. Used by the scheduler of the event daemon.
+
+    @param yaml_file - String location of a yaml file.
+    @param name - String project name
+    @returns Integer bytes cloned from the source or None if not synced
+
+    """
+    _config = config.get_config(yaml_file)
+    p = _config.project(name)
+    if not p:
+        logger.error("Project %s: Not in configuration" % name)
+        return None
+
+    start = time.time()
+    nbytes = ensure_project(p, _config.downstream(name), _config,
+                            memo=get_memo(_config))
+    logger.info("Project %s: sync finished in %s seconds."
+                % (name, time.time() - start))
+    return nbytes
+
+
+def sync_refs(yaml_file, name, updates):
+    """
+    Syncs only the refs of a project named by ref-updated events. Used by
+    the scheduler of the event daemon. Falls back to a full sync of the
+    project when it was never synced or its refs on gerrit diverged.
+
+    @param yaml_file - String location of a yaml file.
+    @param name - String project name
+    @param updates - List of (ref name, old revision, new revision) tuples
+    @returns Integer bytes fetched from the source or None if not synced
+
+    """
+    _config = config.get_config(yaml_file)
+    p = _config.project(name)
+    if not p:
+        logger.error("Project %s: Not in configuration" % name)
+        return None
+
+    if not all(ref for ref, _, _ in updates):
+        logger.info("Project %s: Ref update without ref, syncing fully."
+                    % name)
+        return sync_one(yaml_file, name)
+
+    memo = get_memo(_config)
+    if not memo.known('project', name):
+        logger.info("Project %s: Not mirrored yet, syncing fully." % name)
+        return sync_one(yaml_file, name)
+
+    remote = _config.downstream(name)
+    start = time.time()
+    try:
+        nbytes = p.sync_refs(remote, _config, updates)
+    except Exception:
+        logger.exception("Project %s: Unable to sync refs." % name)
+        nbytes = None
+
+    if nbytes is None:
+        logger.info("Project %s: Refs diverged, syncing fully." % name)
+        return sync_one(yaml_file, name)
+
+    # Keep the memo current so the next poll does not sync fully
+    try:
+        memo.refresh('project', name, p.fingerprint(),
+                     p.remote_state(remote))
+    except Exception:
+        logger.exception("Project %s: Unable to refresh memo." % name)
+
+    logger.info("Project %s: ref sync finished in %s seconds."
+                % (name, time.time() - start))
+    return nbytes
+
+
+def merge_syncs(pending, task):
+    """
+    Merges a sync submitted for a project with its pending sync. A full
+    sync covers ref updates and ACL reapplies, so it absorbs them. Ref
+    syncs are combined. A ref sync and an ACL reapply become a full sync.
+
+    @param pending - scheduler.Task
+    @param task - scheduler.Task
+    @returns scheduler.Task to keep
+
+    """
+    if task.func is sync_one:
+        return task
+    if pending.func is sync_one:
+        return pending
+    if task.func is pending.func:
+        if task.func is sync_refs:
+            yaml_file, name, updates = task.args
+            task.args = [yaml_file, name, pending.args[2] + updates]
+        return task
+    task.func = sync_one
+    task.args = task.args[:2]
+    return task
+
+
+def sync_acl(yaml_file, name, revision=None):
+    """
+    Reapplies the configured ACL of a project whose refs/meta/config was
+    updated on gerrit. Used by the scheduler of the event daemon. Updates
+    to the revision last pushed or found in sync by this tool are ignored.
+
+    @param yaml_file - String location of a yaml file.
+    @param name - String project name
+    @param revision - String new sha of refs/meta/config or None
+    @returns None. Nothing is cloned, so no bytes are reported to the
+        scheduler.
+
+    """
+    _config = config.get_config(yaml_file)
+    p = _config.project(name)
+    if not p or not p.config:
+        logger.debug("Project %s: No configured ACL" % name)
+        return None
+
+    store = state.get_store(_config['state']['file'])
+    if revision and store.get('acl', name) == revision:
+        logger.debug("Project %s: refs/meta/config at %s is ours."
+                     % (name, revision))
+        return None
+
+    logger.info("Project %s: refs/meta/config changed to %s, reapplying ACL."
+                % (name, revision))
+    remote = _config.downstream(name)
+    p._config(remote, _config, gerrit.get_groups(remote))
+    return None
+
+
+def resync(yaml_file=None, changes=None, schedule=None):
+    """
+    Syncs only the groups, users and projects named by a configuration
+    diff. Used when the configuration changes so the cost of a sync is
+    proportional to the size of the change. With a schedule, projects are
+    submitted to it one sync each instead of synced here, so they follow
+    its one sync per project rule and their cost is recorded.
+
+    @param yaml_file - String location of a yaml file.
+    @param changes - config.ConfigDiff
+    @param schedule - scheduler.Scheduler or None
+
+    """
+    if changes.full and schedule is None:
+        return sync(yaml_file=yaml_file)
+
+    try:
+        _config = config.get_config(yaml_file)
+
+        start = time.time()
+        logger.info("gerrit-sync resync starting. Groups: %s Users: %s "
+                    "Projects: %s" % (changes.groups, changes.users,
+                                      changes.projects))
+
+        # Changed entities never match the memo, it is only updated here.
+        memo = get_memo(_config)
+
+        # A full diff syncs everything
+        full = changes.full
+        if full or changes.groups:
+            sync_groups(_config, names=None if full else changes.groups,
+                        memo=memo)
+
+        if full or changes.users:
+            sync_users(_config, names=None if full else changes.users,
+                       memo=memo)
+
+        projects = list(_config.projects) if full else changes.projects
+        if projects and schedule is not None:
+            for name in projects:
+                schedule.submit(name, sync_one, [yaml_file, name],
+                                merge=merge_syncs)
+        elif projects:
+            sync_projects(_config, specific=projects, memo=memo,
+                          jobs=_config['sync']['jobs'])
+
+        duration = time.time() - start
+        msg = "gerrit-sync resync finished in %s seconds." % duration
+        logger.info(msg)
+        print msg
+    except Exception as e:
+        logging.exception("Error occurred:")
+        raise e
+
+
+def spread(name):
+    """
+    Returns a stable fraction in [0, 1) derived from name. Used to spread
+    the first poll of each project over its interval.
+
+    @param name - String
+    @returns Float
+
+    """
+    return int(hashlib.md5(name).hexdigest()[:8], 16) / float(0x100000000)
+
+
+class MirrorDaemon(object):
+    """
+    Long running mirror. Polls the source of every project with a source
+    on a per project interval using git ls-remote, and syncs only projects
+    whose source refs moved since they were last seen. State is kept in the
+    state store under the mirror namespace.
+
+    """
+    def __init__(self, yaml_file):
+        """
+        Inits the daemon and schedules the first poll of every project.
+
+        @param yaml_file - String location of a yaml file.
+
+        """
+        self.yaml_file = yaml_file
+        self.conf = config.get_config(yaml_file)
+        self.store = state.get_store(self.conf['state']['file'])
+        self.pool = thread.WorkerPool(int(self.conf['mirror']['numthreads']))
+        self.heap = []
+        self.scheduled = set()
+        self.busy = set()
+        self._lock = threading.Lock()
+        self.next_report = time.time() + float(self.conf['mirror']['report'])
+
+        for project in self.conf.projects.itervalues():
+            self.schedule(project, initial=True)
+
+    def mirrored(self, project):
+        """
+        Returns whether or not a project is mirrored from a source.
+
+        @param project - gerrit.Project
+        @returns Boolean
+
+        """
+        return bool(project.source and (project.heads or project.tags))
+
+    def interval(self, project):
+        """
+        Returns the poll interval of a project in seconds.
+
+        @param project - gerrit.Project
+        @returns Float
+
+        """
+        return float(project.poll_interval or self.conf['mirror']['interval'])
+
+    def schedule(self, project, initial=False):
+        """
+        Schedules the next poll of a project. The first poll is offset by a
+        stable fraction of the interval so polls do not burst.
+
+        @param project - gerrit.Project
+        @param initial - Boolean whether or not this is the first poll
+
+        """
+        if not self.mirrored(project):
+            return
+        interval = self.interval(project)
+        delay = spread(project.name) * interval if initial else interval
+        heapq.heappush(self.heap, (time.time() + delay, project.name))
+        self.scheduled.add(project.name)
+
+    def poll(self, conf, project):
+        """
+        Compares the source refs of a project with the refs seen last time
+        and syncs the project if they moved. Runs on a worker thread.
+
+        @param conf - config.Config snapshot
+        @param project - gerrit.Project
+
+        """
+        try:
+            now = time.time()
+            refs = git.ls_remote(project.source, **project.ref_kwargs())
+            fingerprint = utils.fingerprint(sorted(str(r) for r in refs))
+            entry = self.store.get('mirror', project.name, {})
+
+            if entry.get('refs') != fingerprint:
+                logger.info("Project %s: source moved, syncing."
+                            % project.name)
+                entry.setdefault('pending', now)
+                self.store.set('mirror', project.name, entry)
+
+                ensure_project(project, conf.downstream(project.name), conf,
+                               memo=get_memo(conf))
+
+                entry.pop('pending')
+                entry['refs'] = fingerprint
+                entry['synced'] = time.time()
+
+            # Downstream matched the source as of the start of this poll
+            entry['in_sync'] = now
+            entry['checked'] = now
+            self.store.set('mirror', project.name, entry)
+
+        except Exception:
+            logger.exception("Project %s: Unable to poll" % project.name)
+
+        finally:
+            with self._lock:
+                self.busy.discard(project.name)
+
+    def lag(self):
+        """
+        Returns how far behind its source each mirrored project may be, as
+        the seconds since downstream was last known to match the source.
+
+        @returns Dictionary of seconds keyed by project name
+
+        """
+        now = time.time()
+        return dict((name, now - entry.get('in_sync', 0))
+                    for name, entry in self.store.items('mirror')
+                    if name in self.scheduled)
+
+    def report(self):
+        """
+        Logs the projects lagging furthest behind their sources.
+
+        """
+        lag = sorted(self.lag().items(), key=lambda l: l[1], reverse=True)
+        lines = ["Mirror lag for %s project(s), %s busy:"
+                 % (len(self.scheduled), len(self.busy))]
+        for name, seconds in lag[:10]:
+            lines.append("  %-40s %.0f seconds" % (name, seconds))
+        logger.info("\n".join(lines))
+
+    def reload(self):
+        """
+        Switches to a changed configuration. Changed groups, users and
+        projects are resynced and new projects are scheduled for polling.
+        The current configuration is kept if the reload fails.
+
+        """
+        try:
+            latest = config.get_config(self.yaml_file)
+        except Exception:
+            logger.exception("Unable to reload configuration %s."
+                             % self.yaml_file)
+            return
+        if latest is self.conf:
+            return
+
+        logger.info("Configuration %s reloaded." % self.yaml_file)
+        changes = config.diff(self.conf, latest)
+        self.conf = latest
+
+        if changes.full or changes.groups or changes.users or \
+                changes.projects:
+            self.pool.add_task(resync, yaml_file=self.yaml_file,
+                               changes=changes)
+
+        for project in self.conf.projects.itervalues():
+            if project.name not in self.scheduled:
+                self.schedule(project, initial=True)
+
+    def run(self):
+        """
+        Runs until killed. Each iteration picks up configuration changes,
+        then dispatches the next due poll. Sleeps until the next poll is
+        due if there is nothing to do.
+
+        """
+        while True:
+            self.reload()
+            now = time.time()
+
+            if now >= self.next_report:
+                self.report()
+                self.next_report = now + float(self.conf['mirror']['report'])
+
+            if not self.heap or self.heap[0][0] > now:
+                wait = self.heap[0][0] - now if self.heap else 1
+                time.sleep(max(0.1, min(wait, 1)))
+                continue
+
+            _, name = heapq.heappop(self.heap)
+            self.scheduled.discard(name)
+
+            # Projects removed from the configuration are dropped
+            project = self.conf.project(name)
+            if not project:
+                continue
+
+            with self._lock:
+                busy = name in self.busy
+                self.busy.add(name)
+
+            if busy:
+                logger.debug("Project %s: still syncing, skipping poll."
+                             % name)
+            else:
+                self.pool.add_task(self.poll, self.conf, project)
+            self.schedule(project)
+
+
+def sync_daemon(yaml_file=None):
+    """
+    Runs gerrit-sync as a long running incremental mirror. See
+    MirrorDaemon.
+
+    @param yaml_file - String location of a yaml file.
+
+    """
+    # Register the signal handler to kill threads
+    signal.signal(signal.SIGINT, thread.stop_threads)
+    signal.signal(signal.SIGTERM, thread.stop_threads)
+
+    # Reload the configuration on SIGHUP
+    signal.signal(signal.SIGHUP, config.reload_configs)
+
+    logger.info("gerrit-sync daemon starting...")
+    configure_ssh(config.get_config(yaml_file))
+    MirrorDaemon(yaml_file).run()
@@ -57,7 +57,7 @@ class Worker(StoppableThread):
         Checks to see if the thread should stop.
         Tries to pull a tuple from the queue.
         The tuple should be in the form (function, args, kwargs)
-        Sleeps if the queue is empty.
+        Waits up to a second for a task if the queue is empty.
 
         """
         while True:
@@ -68,20 +68,23 @@ class Worker(StoppableThread):
 
             # Try to pull from the queue
             try:
-                func, args, kwargs = self.queue.get_nowait()
-                func(*args, **kwargs)
+                func, args, kwargs = self.queue.get(timeout=1)
             except Queue.Empty:
-                time.sleep(5)
                 continue
+
+            try:
+                func(*args, **kwargs)
             except Exception as e:
                 logger.exception(e)
+            finally:
+                self.queue.task_done()
 
 
 class WorkerPool(object):
     """
     Worker thread pool. Initializes the indicated number of worker threads
-    with a shared queue. Very dumb pool that can't be changed after initting
-    aside from adding tasks.
+    with a shared queue. Named queues with their own workers can be added,
+    so tasks of one kind do not wait behind tasks of another.
 
     """
     def __init__(self, numthreads):
@@ -92,10 +95,26 @@ class WorkerPool(object):
 
         """
         self.queue = Queue.Queue()
-        for _ in range(numthreads):
-            Worker(self.queue)
+        self.queues = {}
+        self.workers = [Worker(self.queue) for _ in range(numthreads)]
         logger.debug("Event worker pool started with %s threads." % numthreads)
 
+    def add_queue(self, name, numthreads=1):
+        """
+        Adds a named queue worked by its own threads. Does nothing if the
+        queue exists.
+
+        @param name - String name of the queue
+        @param numthreads - Integer number of worker threads.
+
+        """
+        if name in self.queues:
+            return
+        queue = Queue.Queue()
+        self.queues[name] = queue
+        self.workers.extend(Worker(queue) for _ in range(numthreads))
+        logger.debug("Queue %s started with %s threads." % (name, numthreads))
+
     def add_task(self, func, *args, **kwargs):
         """
         Adds a task in the form of a tuple to the queue.
@@ -107,6 +126,49 @@ class WorkerPool(object):
         """
         self.queue.put((func, args, kwargs))
 
+    def add_named_task(self, name, func, *args, **kwargs):
+        """
+        Adds a task to a named queue.
+
+        @param name - String name of the queue
+        @param func - Function to run with args and kwargs
+        @param *args - Args to send to function
+        @param **kwargs - Kwargs to send to function
+
+        """
+        self.queues[name].put((func, args, kwargs))
+
+    def queue_size(self, name):
+        """
+        Returns the approximate number of tasks waiting in a named queue.
+
+        @param name - String name of the queue
+        @returns Integer
+
+        """
+        return self.queues[name].qsize()
+
+    def wait(self):
+        """
+        Blocks until every task added so far has finished. Polls so the
+        calling thread can still handle signals.
+
+        """
+        queues = [self.queue] + self.queues.values()
+        while any(q.unfinished_tasks for q in queues):
+            time.sleep(0.5)
+
+    def stop(self):
+        """
+        Stops the worker threads of this pool and waits for them to finish
+        their current task.
+
+        """
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+
 
 def stop_threads(signal, frame):
     """
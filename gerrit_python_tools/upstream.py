@@ -1,33 +1,637 @@
+import array
+import collections
 import config
+import functools
 import gerrit
 import log
 import logging
+import re
+import state
+import threading
 import time
 
 
 logger = log.get_logger()
 
+FORCE_PATTERN = re.compile(r'^force-send-upstream\r?$', re.MULTILINE)
 
-def send_upstream(yaml_file, event):
+# A trigger that is a label vote, like Verified+2
+LABEL_VOTE = re.compile(r'^([\w-]+)([+-]\d+)$')
+
+# Bounds of the running min and max of votes
+HIGHEST = 2 ** 31 - 1
+LOWEST = -2 ** 31
+
+
+class AdmissionFilter(object):
+    """
+    Cheap pre-check run by the dispatcher before a comment-added event is
+    queued for sending upstream. Rejects events on projects that are not
+    upstream projects and events whose comment does not carry the trigger.
+    Keeps counters of admitted and rejected events.
+
+    """
+    def __init__(self, conf):
+        """
+        Uses the project index and trigger matchers compiled with the
+        configuration.
+
+        @param conf - config.Config
+
+        """
+        self.conf = conf
+        self.admitted = 0
+        self.rejected = 0
+
+    def admit(self, event):
+        """
+        Returns whether or not the event could lead to a send upstream.
+        Mirrors CommentAdded.is_upstream_project and
+        CommentAdded.is_upstream_indicated without loading anything.
+
+        @param event - Dictionary comment-added event
+        @returns - Boolean
+
+        """
+        try:
+            project = event['change']['project']
+            comment = event.get('comment', '')
+        except (KeyError, TypeError):
+            project = None
+
+        admitted = project in self.conf.upstream_projects and bool(
+            self.conf.trigger(project).search(comment.split('\n', 1)[0]) or
+            FORCE_PATTERN.search(comment)
+        )
+
+        if admitted:
+            self.admitted += 1
+        else:
+            self.rejected += 1
+        logger.debug("Admission filter: %s admitted, %s rejected"
+                     % (self.admitted, self.rejected))
+        return admitted
+
+
+def group_events(events):
+    """
+    Splits comment-added events into groups of one project and branch
+    whose patch sets share a topic or descend from one another. Only the
+    latest event of each patch set is kept.
+
+    @param events - List of comment-added event dictionaries
+    @returns - List of lists of events
+
+    """
+    latest = collections.OrderedDict()
+    for event in events:
+        latest[event['patchSet']['revision']] = event
+    events = latest.values()
+
+    # Union find over the events, linked by revisions and topics
+    parent = range(len(events))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def key(event, kind, value):
+        change = event['change']
+        return (change['project'], change['branch'], kind, value)
+
+    first = {}
+    for i, event in enumerate(events):
+        first[key(event, 'revision', event['patchSet']['revision'])] = i
+
+    for i, event in enumerate(events):
+        # Link to parents that are in the batch too
+        links = [first.get(key(event, 'revision', p))
+                 for p in event['patchSet'].get('parents', [])]
+        topic = event['change'].get('topic')
+        if topic:
+            links.append(first.setdefault(key(event, 'topic', topic), i))
+        for j in links:
+            if j is not None:
+                parent[find(i)] = find(j)
+
+    groups = collections.OrderedDict()
+    for i, event in enumerate(events):
+        groups.setdefault(find(i), []).append(event)
+    return groups.values()
+
+
+class Batcher(object):
+    """
+    Holds admitted comment-added events for window seconds after the first
+    one arrives so changes of a series or topic triggered together are
+    sent together.
+
+    """
+    def __init__(self, window):
+        """
+        Inits the batcher.
+
+        @param window - Float seconds to hold events
+
+        """
+        self.window = float(window)
+        self._events = []
+        self._first = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns the number of held events.
+
+        @returns Integer
+
+        """
+        return len(self._events)
+
+    def add(self, event):
+        """
+        Holds an event.
+
+        @param event - Dictionary comment-added event
+
+        """
+        with self._lock:
+            if not self._events:
+                self._first = time.time()
+            self._events.append(event)
+
+    def flush(self, now=None):
+        """
+        Returns the held events grouped by group_events once the window
+        has passed, or an empty list.
+
+        @param now - Float current time
+        @returns - List of lists of events
+
+        """
+        now = now or time.time()
+        with self._lock:
+            if not self._events or now - self._first < self.window:
+                return []
+            events = self._events
+            self._events = []
+            self._first = None
+        return group_events(events)
+
+
+class StatusReconciler(object):
+    """
+    Mirrors the status of changes sent upstream back to downstream. The
+    changes the ledger has as sent are looked up upstream with one OR
+    query per batch of Change-Ids. When a change was merged, abandoned or
+    got a new patch set since it was last seen, a comment is queued on the
+    patch set that was sent. The last status seen is kept in the state
+    store under the upstream-status namespace. Once a change is merged or
+    abandoned its ledger entries and status are dropped, so the work of a
+    run only grows with the number of open changes.
+
+    """
+    FINAL = ('MERGED', 'ABANDONED')
+
+    def __init__(self, store, batch=100):
+        """
+        Inits the reconciler.
+
+        @param store - state.Store
+        @param batch - Integer number of Change-Ids per query
+
+        """
+        self.store = store
+        self.ledger = state.Ledger(store)
+        self.batch = int(batch)
+        self._lock = threading.Lock()
+
+        # Sends recorded before sent entries were kept apart
+        indexed = self.ledger.index()
+        if indexed:
+            logger.info("Indexed %s sent patch set(s)." % indexed)
+
+    @staticmethod
+    def key(project, branch, change_id):
+        """
+        Returns the state key of a change.
+
+        @param project - String project name
+        @param branch - String branch name
+        @param change_id - String Change-Id
+        @returns String
+
+        """
+        return '%s,%s,%s' % (project, branch, change_id)
+
+    def tracked(self):
+        """
+        Returns the latest sent patch set of every change that is not
+        merged or abandoned upstream yet, grouped by project. Each entry
+        lists the ledger keys of all sent patch sets of its change under
+        keys. Changes already seen merged or abandoned are dropped.
+
+        @returns - Dictionary of project name to a dictionary of state key
+            to ledger entry
+
+        """
+        seen = dict(self.store.items('upstream-status'))
+        tracked = {}
+        final = {}
+        for ledger_key, entry in self.ledger.sent():
+            key = self.key(entry['project'], entry['branch'],
+                           entry['change_id'])
+            if seen.get(key, {}).get('status') in self.FINAL:
+                final.setdefault(key, []).append(ledger_key)
+                continue
+            changes = tracked.setdefault(entry['project'], {})
+            latest = changes.get(key)
+            keys = [ledger_key]
+            if latest is not None:
+                keys += latest['keys']
+            if latest is None or entry['patchset'] > latest['patchset']:
+                latest = dict(entry)
+            latest['keys'] = keys
+            changes[key] = latest
+
+        for key, ledger_keys in final.iteritems():
+            self.ledger.forget(ledger_keys)
+            self.store.delete('upstream-status', key)
+        return tracked
+
+    def record(self, key, entry, status):
+        """
+        Records the status of a change seen upstream. A change that was
+        merged or abandoned is no longer tracked, so its ledger entries and
+        status are dropped instead.
+
+        @param key - String state key of the change
+        @param entry - Dictionary tracked entry of the change
+        @param status - Dictionary status to record
+
+        """
+        if status['status'] in self.FINAL:
+            self.ledger.forget(entry['keys'])
+            self.store.delete('upstream-status', key)
+        else:
+            self.store.set('upstream-status', key, status)
+
+    def message(self, change, last):
+        """
+        Returns the comment describing what changed upstream or None. The
+        first lookup of a change only records a baseline, so it never gets
+        a comment.
+
+        @param change - gerrit.Change as it is upstream
+        @param last - Dictionary last status seen or None
+        @returns - String | None
+
+        """
+        if last is None:
+            return None
+        if change.status != last['status']:
+            if change.status in self.FINAL:
+                return ('Upstream change %s was %s.'
+                        % (change.url, change.status.lower()))
+            return ('Upstream change %s is now %s.'
+                    % (change.url, change.status.lower()))
+
+        current = change.current_patch_set
+        patchset = int(current['number']) if current else None
+        if last['patchset'] is not None and patchset != last['patchset']:
+            return ('Upstream change %s has a new patch set %s.'
+                    % (change.url, patchset))
+        return None
+
+    def reconcile(self, conf):
+        """
+        Looks up the tracked changes on the upstream of their project and
+        comments on the ones whose status changed on their downstream. Does
+        nothing if a run is in progress.
+
+        @param conf - config.Config
+
+        """
+        if not self._lock.acquire(False):
+            logger.debug("Status reconciliation already running.")
+            return
+        try:
+            updated = 0
+            for project, changes in sorted(self.tracked().iteritems()):
+                reviews = conf.downstream(project).ReviewQueue()
+                pool = conf.upstream(project).SSHPool()
+                keys = sorted(changes)
+                for i in range(0, len(keys), self.batch):
+                    batch = keys[i:i + self.batch]
+                    terms = ' OR '.join('change:%s'
+                                        % changes[k]['change_id']
+                                        for k in batch)
+                    query = gerrit.Query(pool, 'project:%s (%s)'
+                                         % (project, terms),
+                                         fields=['current-patch-set'])
+                    for change in query:
+                        key = self.key(change.project, change.branch,
+                                       change.id)
+                        entry = changes.get(key)
+                        if entry is None:
+                            continue
+                        last = self.store.get('upstream-status', key)
+                        msg = self.message(change, last)
+                        if msg is None and last is not None:
+                            continue
+                        current = change.current_patch_set
+                        status = {
+                            'status': change.status,
+                            'patchset': (int(current['number'])
+                                         if current else None),
+                            'time': time.time()
+                        }
+                        record = functools.partial(self.record, key, entry,
+                                                   status)
+                        if msg is None:
+                            record()
+                            continue
+                        # The status is kept once the comment is posted, so
+                        # a failed post is retried by the next run.
+                        reviews.post(entry['revision'], msg, record)
+                        updated += 1
+            logger.info("Status reconciliation: %s change(s) updated."
+                        % updated)
+        finally:
+            self._lock.release()
+
+
+class TriggerSweep(object):
+    """
+    Finds upstream-ready changes whose trigger was missed, for example while
+    the daemon was down. Open changes on upstream projects that carry the
+    trigger vote and were updated since the last sweep are queried on
+    downstream. Their label gates are evaluated together, and approved
+    patch sets the ledger has not seen are queued like comment-added
+    events. Projects whose trigger is not a label vote are skipped.
+
+    The failure comment of a send updates the change, so a failed patch
+    set would be found by every sweep. Failed patch sets are only retried
+    once their backoff passed, and at most retries times.
+
+    """
+    def __init__(self, store):
+        """
+        Inits the sweep.
+
+        @param store - state.Store
+
+        """
+        self.store = store
+        self.ledger = state.Ledger(store)
+        self._lock = threading.Lock()
+
+    def shards(self, conf):
+        """
+        Returns a query shard per upstream project with a label vote
+        trigger, grouped by the downstream remote of the project.
+
+        @param conf - config.Config
+        @returns - Dictionary of remote name to list of strings
+
+        """
+        shards = {}
+        for name in sorted(conf.upstream_projects):
+            match = LABEL_VOTE.match(conf.trigger_text(name))
+            if not match:
+                logger.debug("Project %s: Trigger is not a label vote."
+                             % name)
+                continue
+            downstream, _ = conf.remote_names(name)
+            shards.setdefault(downstream, []).append(
+                'project:%s label:%s%s' % (name, match.group(1),
+                                           match.group(2))
+            )
+        return shards
+
+    def approved(self, conf, changes):
+        """
+        Returns the changes whose current patch set passes the label gates
+        of its project, like Label.approved. The votes of all changes are
+        gathered in one pass into flat arrays holding the running min and
+        max of each change and label.
+
+        @param conf - config.Config
+        @param changes - List of gerrit.Change with current patch sets
+        @returns - List of gerrit.Change
+
+        """
+        columns = {}
+        offsets = []
+        total = 0
+        for change in changes:
+            if change.project not in columns:
+                policies = conf.label_policies(change.project)
+                columns[change.project] = dict(
+                    (p.name, i) for i, p in enumerate(policies)
+                )
+            offsets.append(total)
+            total += len(columns[change.project])
+
+        lows = array.array('i', [HIGHEST]) * total
+        highs = array.array('i', [LOWEST]) * total
+        for row, change in enumerate(changes):
+            column = columns[change.project]
+            patch_set = change.current_patch_set or {}
+            for approval in patch_set.get('approvals', []):
+                col = column.get(approval.get('type'))
+                if col is None:
+                    continue
+                i = offsets[row] + col
+                value = int(approval['value'])
+                if value < lows[i]:
+                    lows[i] = value
+                if value > highs[i]:
+                    highs[i] = value
+
+        approved = []
+        for row, change in enumerate(changes):
+            base = offsets[row]
+            policies = conf.label_policies(change.project)
+            if all(highs[base + i] != LOWEST and
+                   lows[base + i] > p.min and
+                   highs[base + i] >= p.max
+                   for i, p in enumerate(policies)):
+                approved.append(change)
+        return approved
+
+    def event(self, conf, change):
+        """
+        Returns a comment-added event carrying the trigger for a change.
+
+        @param conf - config.Config
+        @param change - gerrit.Change
+        @returns - Dictionary
+
+        """
+        data = {
+            'project': change.project,
+            'branch': change.branch,
+            'id': change.id,
+            'number': str(change.number)
+        }
+        if change.topic:
+            data['topic'] = change.topic
+        return {
+            'type': 'comment-added',
+            'change': data,
+            'patchSet': change.current_patch_set,
+            'comment': conf.trigger_text(change.project),
+            'author': {'name': 'Missed trigger sweep', 'email': ''}
+        }
+
+    def retry(self, key, retries, now):
+        """
+        Returns whether or not a patch set is due to be sent by the sweep.
+
+        @param key - String ledger key
+        @param retries - Integer number of times failed sends are retried
+        @param now - Float current time
+        @returns - Boolean
+
+        """
+        if self.ledger.lookup(key):
+            return False
+        entry = self.ledger.failed(key)
+        if entry is None:
+            return True
+        return entry['attempts'] <= retries and now >= entry['retry']
+
+    def sweep(self, conf, batcher, overlap=300, retries=3):
+        """
+        Queues approved, unsent patch sets of changes updated since the last
+        sweep on each downstream. Does nothing if a sweep is in progress.
+        The first sweep only records when it ran, since without a previous
+        sweep every open change would be looked at.
+
+        @param conf - config.Config
+        @param batcher - Batcher to queue events on
+        @param overlap - Integer seconds added to the age of the last
+            sweep to cover events in flight
+        @param retries - Integer number of times failed sends are retried
+
+        """
+        if not self._lock.acquire(False):
+            logger.debug("Trigger sweep already running.")
+            return
+        try:
+            start = time.time()
+            shards = self.shards(conf)
+            if not shards:
+                return
+
+            # Only changes updated since the last sweep
+            last = self.store.get('sweep', 'last')
+            if not last:
+                logger.info("First trigger sweep, recording a baseline.")
+                self.store.set('sweep', 'last', start)
+                return
+            query = 'status:open -age:%ds' % int(start - last + overlap)
+
+            changes = []
+            for name, remote_shards in sorted(shards.iteritems()):
+                changes.extend(gerrit.Query(conf.remotes[name].SSHPool(),
+                                            query,
+                                            fields=['current-patch-set'],
+                                            shards=remote_shards))
+            queued = 0
+            for change in self.approved(conf, changes):
+                patch_set = change.current_patch_set
+                key = self.ledger.key(change.number,
+                                      int(patch_set['number']),
+                                      patch_set['revision'])
+                if not self.retry(key, retries, start):
+                    continue
+                logger.info("Change %s: Queuing missed trigger."
+                            % change.id)
+                batcher.add(self.event(conf, change))
+                queued += 1
+
+            self.store.set('sweep', 'last', start)
+            logger.info("Trigger sweep: %s change(s) checked, %s queued."
+                        % (len(changes), queued))
+        finally:
+            self._lock.release()
+
+
+def sweep(yaml_file, trigger_sweep, batcher):
+    """
+    Runs a missed trigger sweep with the current configuration.
+
+    @param yaml_file - String yaml file name
+    @param trigger_sweep - TriggerSweep
+    @param batcher - Batcher to queue events on
+
+    """
+    try:
+        _config = config.get_config(yaml_file)
+        trigger_sweep.sweep(_config, batcher,
+                            overlap=int(_config['sweep']['overlap']),
+                            retries=int(_config['sweep']['retries']))
+    except Exception as e:
+        logging.exception("Error occurred:")
+        raise e
+
+
+def reconcile(yaml_file, reconciler):
     """
-    Creates a gerrit.commentAdded event. Lets the commentAdded object
-    decide whether or not sending a proposed change to upstream is necessary.
+    Runs a status reconciliation with the current configuration.
 
     @param yaml_file - String yaml file name
-    @param event - String event that should contain json
+    @param reconciler - StatusReconciler
 
     """
     try:
-        _config = config.load_config(yaml_file)
+        _config = config.get_config(yaml_file)
+        reconciler.batch = int(_config['reconcile']['batch'])
+        reconciler.reconcile(_config)
+    except Exception as e:
+        logging.exception("Error occurred:")
+        raise e
+
+
+def send_batch(yaml_file, events):
+    """
+    Sends the patch sets of a group of comment-added events upstream
+    together. See gerrit.send_changes.
+
+    @param yaml_file - String yaml file name
+    @param events - List of comment-added event dictionaries of one
+        project and branch
+
+    """
+    try:
+        _config = config.get_config(yaml_file)
 
         start = time.time()
-        logger.info("send upstream starting...")
+        logger.info("send upstream starting for %s event(s)..."
+                    % len(events))
+
+        # Events are grouped per project, so they share their remotes
+        project = events[0]['change']['project']
+        downstream = _config.downstream(project)
+        upstream = _config.upstream(project)
 
-        downstream = gerrit.Remote(_config['gerrit'])
-        upstream = gerrit.Remote(_config['upstream'])
+        ledger = state.Ledger(state.get_store(_config['state']['file']))
 
-        event_obj = gerrit.CommentAdded(event, _config)
-        event_obj.send_upstream(downstream, upstream)
+        changes = [gerrit.CommentAdded(event, _config) for event in events]
+        ready = []
+        try:
+            for change in changes:
+                if change.ready(downstream, ledger=ledger):
+                    ready.append(change)
+        finally:
+            # Claimed patch sets are sent or released even if a later
+            # check failed
+            gerrit.send_changes(_config, downstream, upstream, ready,
+                                ledger=ledger)
 
         duration = time.time() - start
         msg = "send upstream run finished in %s seconds." % duration
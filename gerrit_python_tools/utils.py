@@ -1,50 +1,150 @@
+import hashlib
 import json
+import os
 import cStringIO
 
 
+def disk_usage(path):
+    """
+    Returns the total size in bytes of the files under path.
+
+    @param path - String directory
+    @return - Integer
+
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def fingerprint(*things):
+    """
+    Returns a stable sha1 hex digest of json serializable things.
+    Mappings that are not dictionaries are serialized as dictionaries.
+
+    @param *things - Things to fingerprint
+    @return - String
+
+    """
+    data = json.dumps(things, sort_keys=True, default=dict)
+    return hashlib.sha1(data).hexdigest()
+
+
+# Interned strings. See intern_string.
+_interned = {}
+
+
+def intern_string(value):
+    """
+    Returns a canonical copy of a string, so strings repeated across many
+    objects, like project and branch names, are stored once. Unlike the
+    intern builtin this works for unicode strings as well.
+
+    @param value - String or None
+    @return - String or None
+
+    """
+    if value is None:
+        return None
+    return _interned.setdefault(value, value)
+
+
 class MultiJSON(object):
     """
-    Class for parsing multiple JSON objects out of a single string.
+    Lazily parses newline separated JSON objects, like the output of
+    gerrit query --format JSON. Lines are decoded one at a time as results
+    are asked for and reading stops after limit results. The stats row
+    gerrit query ends with is kept apart from the results. The input is
+    read once, so the results can only be iterated over once.
 
     """
-    def __init__(self, data):
+    def __init__(self, data, limit=None):
         """
-        Inits the MultiJSON object. Places the string into a cStringIO
-        and reads one line at a time. json.loads is then executed on each
-        line.
+        Inits the MultiJSON object. Nothing is decoded yet.
 
-        @param data - String containing multiple json objects
+        @param data - String containing multiple json objects or an
+            iterable of lines such as SSH.exec_lines
+        @param limit - Integer maximum number of results or None
 
         """
-        buffer_ = cStringIO.StringIO(data)
-        self.objects = [json.loads(line, strict=False)
-                        for line in buffer_.readlines()]
+        if isinstance(data, basestring):
+            data = cStringIO.StringIO(data)
+        self._source = data
+        self._lines = iter(data)
+        self._stats = None
+        self.limit = limit
+        self.count = 0
 
-    def __getitem__(self, index):
+    @staticmethod
+    def is_stats(obj):
         """
-        Returns the json object at index index.
+        Returns whether or not a json object is a gerrit query stats row.
 
-        @param index - Integer index
-        @return - JSON object
+        @param obj - JSON object
+        @return - Boolean
 
         """
-        return self.objects[index]
+        return isinstance(obj, dict) and obj.get('type') == 'stats'
 
     def __iter__(self):
         """
-        Iterate over the objects
+        Iterate over the results
 
         @yields - Parsed json object.
 
         """
-        for obj in self.objects:
+        while self.limit is None or self.count < self.limit:
+            line = next(self._lines, None)
+            if line is None:
+                return
+            if not line.strip():
+                continue
+            obj = json.loads(line, strict=False)
+            if self.is_stats(obj):
+                self._stats = obj
+                continue
+            self.count += 1
             yield obj
 
-    def __len__(self):
+    def first(self):
+        """
+        Returns the first result or None if there are no results.
+
+        @return - JSON object | None
+
+        """
+        for obj in self:
+            return obj
+        return None
+
+    @property
+    def stats(self):
         """
-        Return the number of json objects.
+        Returns the stats row or None. Reads the rest of the input but only
+        decodes the stats row.
+
+        @return - JSON object | None
 
-        @return - Integer
+        """
+        if self._stats is None:
+            for line in self._lines:
+                if '"stats"' in line:
+                    obj = json.loads(line, strict=False)
+                    if self.is_stats(obj):
+                        self._stats = obj
+        return self._stats
+
+    def close(self):
+        """
+        Closes the input if it can be closed, like the generator returned by
+        SSH.exec_lines.
 
         """
-        return len(self.objects)
+        close = getattr(self._source, 'close', None)
+        if close:
+            close()
@@ -0,0 +1,341 @@
+"""
+Pool of reusable scratch repositories. Instead of creating and deleting a
+directory for every operation, repositories are kept per project, reset
+between uses and reused, so they keep their objects between operations.
+
+Layout under the root directory:
+    <root>/<kind>/<quoted project name>/<id>       repository
+    <root>/<kind>/<quoted project name>/<id>.lock  held while in use
+
+"""
+import contextlib
+import errno
+import git
+import log
+import os
+import shutil
+import threading
+import time
+import urllib
+import utils
+from uuid import uuid4
+
+logger = log.get_logger()
+
+# Kinds of workspaces. work repos have a working tree, bare repos do not.
+WORK = 'work'
+BARE = 'bare'
+KINDS = (WORK, BARE)
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def pid_alive(pid):
+    """
+    Returns whether or not a process with pid exists.
+
+    @param pid - Integer process id
+    @returns Boolean
+
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class WorkspaceManager(object):
+    """
+    Hands out scratch repositories per project and kind. Released
+    repositories are reset and kept idle, up to size per project and kind,
+    as long as the pool stays within quota bytes. Lock files make a
+    repository usable by one process at a time, and let leaked
+    repositories be found at startup.
+
+    """
+    def __init__(self, root, size=1, quota=0):
+        """
+        Inits the manager and cleans up leaked workspaces.
+
+        @param root - String directory holding the workspaces
+        @param size - Integer idle workspaces kept per project and kind
+        @param quota - Integer bytes the idle workspaces may use. 0 for
+            no limit.
+
+        """
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.size = int(size)
+        self.quota = int(quota)
+        self._idle = {}
+        self._sizes = {}
+        self._released = {}
+        self._lock = threading.Lock()
+        self.cleanup()
+
+    def _project_dir(self, project, kind):
+        """
+        Returns the directory holding the workspaces of a project.
+
+        @param project - String project name
+        @param kind - String WORK or BARE
+        @returns String
+
+        """
+        return os.path.join(self.root, kind, urllib.quote(project, safe=''))
+
+    def _try_lock(self, path):
+        """
+        Creates the lock file of a workspace.
+
+        @param path - String workspace directory
+        @returns Boolean - True if the lock was taken
+
+        """
+        try:
+            fd = os.open(path + '.lock', os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        return True
+
+    def _unlock(self, path):
+        """
+        Removes the lock file of a workspace.
+
+        @param path - String workspace directory
+
+        """
+        try:
+            os.remove(path + '.lock')
+        except OSError:
+            pass
+
+    def _destroy(self, path):
+        """
+        Deletes a workspace and its lock file. The caller must hold the
+        lock of the workspace, since other processes share the root.
+
+        @param path - String workspace directory
+
+        """
+        logger.debug("Removing workspace %s" % path)
+        shutil.rmtree(path, ignore_errors=True)
+        self._sizes.pop(path, None)
+        self._released.pop(path, None)
+        self._unlock(path)
+
+    def cleanup(self):
+        """
+        Removes workspaces leaked by processes that died while using them
+        and adopts idle workspaces left by earlier runs, up to size per
+        project and kind. Workspaces locked by live processes are left
+        alone.
+
+        """
+        for kind in KINDS:
+            kind_dir = os.path.join(self.root, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for quoted in os.listdir(kind_dir):
+                project = urllib.unquote(quoted)
+                project_dir = os.path.join(kind_dir, quoted)
+                entries = set(os.listdir(project_dir))
+
+                for entry in sorted(entries):
+                    if not entry.endswith('.lock'):
+                        continue
+                    path = os.path.join(project_dir, entry[:-len('.lock')])
+                    try:
+                        with open(path + '.lock', 'r') as f:
+                            pid = int(f.read() or 0)
+                    except (IOError, ValueError):
+                        pid = 0
+                    if pid and pid != os.getpid() and pid_alive(pid):
+                        entries.discard(entry[:-len('.lock')])
+                        continue
+                    logger.info("Removing leaked workspace %s" % path)
+                    self._destroy(path)
+                    entries.discard(entry[:-len('.lock')])
+
+                for entry in sorted(entries):
+                    path = os.path.join(project_dir, entry)
+                    if entry.endswith('.lock') or not os.path.isdir(path):
+                        continue
+                    idle = self._idle.setdefault((project, kind), [])
+                    if len(idle) < self.size:
+                        idle.append(path)
+                        self._sizes[path] = utils.disk_usage(path)
+                        self._released[path] = time.time()
+                    elif self._try_lock(path):
+                        self._destroy(path)
+        self._enforce_quota()
+
+    def prewarm(self, projects, kind=WORK):
+        """
+        Makes sure every project has an initialized idle workspace.
+
+        @param projects - List of project names
+        @param kind - String WORK or BARE
+
+        """
+        for project in projects:
+            if not self._idle.get((project, kind)):
+                path = self.acquire(project, kind)
+                self.release(project, kind, path)
+
+    def acquire(self, project, kind=WORK):
+        """
+        Returns the directory of an initialized workspace for project,
+        reusing an idle one when possible.
+
+        @param project - String project name
+        @param kind - String WORK or BARE
+        @returns String
+
+        """
+        with self._lock:
+            idle = self._idle.get((project, kind), [])
+            while idle:
+                path = idle.pop()
+                if not self._try_lock(path):
+                    continue
+                # Another process may have deleted it before we locked it
+                if not os.path.isdir(path):
+                    self._sizes.pop(path, None)
+                    self._released.pop(path, None)
+                    self._unlock(path)
+                    continue
+                logger.debug("Reusing workspace %s" % path)
+                return path
+
+        path = os.path.join(self._project_dir(project, kind), str(uuid4()))
+        os.makedirs(path)
+        self._try_lock(path)
+        git.init(bare=(kind == BARE), cwd=path)
+        logger.debug("Created workspace %s" % path)
+        return path
+
+    def reset(self, kind, path):
+        """
+        Removes transient state from a workspace so it can be reused.
+        Refs and objects are kept.
+
+        @param kind - String WORK or BARE
+        @param path - String workspace directory
+
+        """
+        git_dir = path if kind == BARE else os.path.join(path, '.git')
+        for name in ('FETCH_HEAD', 'index.lock'):
+            try:
+                os.remove(os.path.join(git_dir, name))
+            except OSError:
+                pass
+        if kind == WORK:
+            git.clean(cwd=path)
+
+    def release(self, project, kind, path):
+        """
+        Resets a workspace and keeps it idle, or deletes it if the pool
+        for the project is full or the quota is exceeded.
+
+        @param project - String project name
+        @param kind - String WORK or BARE
+        @param path - String workspace directory
+
+        """
+        try:
+            self.reset(kind, path)
+        except Exception:
+            logger.exception("Unable to reset workspace %s" % path)
+            self.discard(path)
+            return
+
+        size = utils.disk_usage(path)
+        with self._lock:
+            idle = self._idle.setdefault((project, kind), [])
+            if len(idle) >= self.size:
+                self._destroy(path)
+                return
+            idle.append(path)
+            self._sizes[path] = size
+            self._released[path] = time.time()
+            self._unlock(path)
+            self._enforce_quota()
+
+    def discard(self, path):
+        """
+        Deletes a workspace that is in an unknown state.
+
+        @param path - String workspace directory
+
+        """
+        with self._lock:
+            self._destroy(path)
+
+    def _enforce_quota(self):
+        """
+        Deletes the least recently released idle workspaces until the idle
+        workspaces use no more than quota bytes. Workspaces locked by
+        another process are dropped from the pool but not deleted.
+
+        """
+        if not self.quota:
+            return
+        idle = [(self._released.get(path, 0), key, path)
+                for key, paths in self._idle.iteritems() for path in paths]
+        idle.sort()
+        total = sum(self._sizes.get(path, 0) for _, _, path in idle)
+        for _, key, path in idle:
+            if total <= self.quota:
+                break
+            total -= self._sizes.get(path, 0)
+            self._idle[key].remove(path)
+            if self._try_lock(path):
+                self._destroy(path)
+            else:
+                self._sizes.pop(path, None)
+                self._released.pop(path, None)
+
+    @contextlib.contextmanager
+    def workspace(self, project, kind=WORK):
+        """
+        Context manager yielding a workspace directory. The workspace is
+        released on success and deleted if an exception is raised, since
+        its state is unknown.
+
+        @param project - String project name
+        @param kind - String WORK or BARE
+
+        """
+        path = self.acquire(project, kind)
+        try:
+            yield path
+        except:
+            self.discard(path)
+            raise
+        self.release(project, kind, path)
+
+
+def get_manager(conf):
+    """
+    Returns the process wide WorkspaceManager set up from the workspace
+    section of conf.
+
+    @param conf - config.Config
+    @returns WorkspaceManager
+
+    """
+    section = conf['workspace']
+    root = section['root']
+    with _managers_lock:
+        manager = _managers.get(root)
+        if manager is None:
+            manager = WorkspaceManager(root, size=section['size'],
+                                       quota=int(section['quota']) << 20)
+            _managers[root] = manager
+    return manager